@@ -0,0 +1,166 @@
+import warnings
+from itertools import combinations
+import numpy as np
+import pandas as pd
+from scipy.stats import false_discovery_control, levene, ttest_ind_from_stats
+
+STATS_COLUMNS = ['population', 'group_a', 'group_b', 'n_a', 'n_b', 'mean_a', 'mean_b'
+                 , 'levene_p', 'equal_variance', 'test', 't_statistic', 'p_value', 'p_adjusted'
+                 , 'cohens_d', 'hedges_g', 'student_p', 'welch_p']
+
+BOX_COLUMNS = ['population', 'group', 'n', 'q1', 'median', 'q3', 'lower_fence', 'upper_fence', 'mean'
+               , 'n_outliers', 'outliers', 'points']
+
+def sample_matrix(long_df, group_column, value_column='percentage'):
+    """Pivot long frequencies to a samples x populations matrix.
+
+    Returns (populations, matrix, group label per sample). Samples missing a
+    population get NaN in that cell.
+    """
+    if isinstance(long_df['population'].dtype, pd.CategoricalDtype):
+        population_codes = long_df['population'].cat.codes.to_numpy()
+        populations = list(long_df['population'].cat.categories)
+    else:
+        population_codes, populations = pd.factorize(long_df['population'])
+        populations = list(populations)
+    sample_codes, samples = pd.factorize(long_df['sample'])
+
+    matrix = np.full((len(samples), len(populations)), np.nan)
+    matrix[sample_codes, population_codes] = long_df[value_column].to_numpy(dtype=np.float64)
+    labels = np.empty(len(samples), dtype=object)
+    labels[sample_codes] = long_df[group_column].to_numpy(dtype=object)
+    return populations, matrix, labels
+
+def _nan_moments(values):
+    # per column, ignoring NaN: number of values, mean and sample variance
+    n = np.count_nonzero(~np.isnan(values), axis=0)
+    with np.errstate(divide='ignore', invalid='ignore'), warnings.catch_warnings():
+        # columns with fewer than two values come back as NaN
+        warnings.simplefilter('ignore', RuntimeWarning)
+        return n, np.nanmean(values, axis=0), np.nanvar(values, axis=0, ddof=1)
+
+def compare_groups(long_df, group_column='response', groups=None, value_column='percentage', alpha=0.05):
+    """Levene, Student/Welch t-tests and effect sizes for every population and pair of groups.
+
+    Each pair of groups is tested across all populations with one vectorized
+    call per test. The t-test reported in p_value is Student's when Levene
+    finds equal variances (levene_p >= alpha) and Welch's otherwise; p_adjusted
+    is Benjamini-Hochberg over every row of the result.
+    """
+    populations, matrix, labels = sample_matrix(long_df, group_column, value_column)
+    return compare_matrix(populations, matrix, labels, groups, alpha)
+
+def compare_matrix(populations, matrix, labels, groups=None, alpha=0.05):
+    """compare_groups on a samples x populations matrix with one group label per sample."""
+    if groups is None:
+        groups = sorted(pd.unique(labels[pd.notna(labels)]))
+
+    frames = []
+    for group_a, group_b in combinations(groups, 2):
+        a = matrix[labels == group_a]
+        b = matrix[labels == group_b]
+        # NaN cells (e.g. a sample with total_count 0) only drop out of their own population
+        n_a, mean_a, var_a = _nan_moments(a)
+        n_b, mean_b, var_b = _nan_moments(b)
+        with np.errstate(divide='ignore', invalid='ignore'), warnings.catch_warnings():
+            # Brown-Forsythe for every population in one call; ones with too few values get NaN
+            warnings.simplefilter('ignore', RuntimeWarning)
+            levene_p = levene(a, b, center='median', axis=0, nan_policy='omit').pvalue
+            student = ttest_ind_from_stats(mean_a, np.sqrt(var_a), n_a, mean_b, np.sqrt(var_b), n_b, equal_var=True)
+            welch = ttest_ind_from_stats(mean_a, np.sqrt(var_a), n_a, mean_b, np.sqrt(var_b), n_b, equal_var=False)
+            pooled_sd = np.sqrt(((n_a - 1) * var_a + (n_b - 1) * var_b) / (n_a + n_b - 2))
+            cohens_d = (mean_a - mean_b) / pooled_sd
+        equal_variance = levene_p >= alpha
+        frames.append(pd.DataFrame({
+            'population': populations
+            , 'group_a': group_a
+            , 'group_b': group_b
+            , 'n_a': n_a
+            , 'n_b': n_b
+            , 'mean_a': mean_a
+            , 'mean_b': mean_b
+            , 'levene_p': levene_p
+            , 'equal_variance': equal_variance
+            , 'test': np.where(equal_variance, 'standard t-test', "Welch's t-test")
+            , 't_statistic': np.where(equal_variance, student.statistic, welch.statistic)
+            , 'p_value': np.where(equal_variance, student.pvalue, welch.pvalue)
+            , 'cohens_d': cohens_d
+            # small-sample bias correction of d
+            , 'hedges_g': cohens_d * (1 - 3 / (4 * (n_a + n_b) - 9))
+            , 'student_p': student.pvalue
+            , 'welch_p': welch.pvalue
+        }))
+
+    if not frames:
+        return pd.DataFrame(columns=STATS_COLUMNS)
+    result = pd.concat(frames, ignore_index=True)
+    result['p_adjusted'] = np.nan
+    testable = result['p_value'].notna()
+    if testable.any():
+        result.loc[testable, 'p_adjusted'] = false_discovery_control(result.loc[testable, 'p_value'], method='bh')
+    return result[STATS_COLUMNS]
+
+def _sample_values(rng, values, limit, keep_extremes=False):
+    if len(values) <= limit:
+        return values
+    if keep_extremes and limit >= 2:
+        # the smallest and largest values fix the axis range, the rest are drawn at random
+        order = np.argsort(values)
+        rest = rng.choice(order[1:-1], limit - 2, replace=False)
+        return values[np.concatenate([order[[0, -1]], np.sort(rest)])]
+    return values[np.sort(rng.choice(len(values), limit, replace=False))]
+
+def box_summary(long_df, group_column='response', groups=None, value_column='percentage'
+                , max_outliers=50, max_points=0, seed=0):
+    """Box-plot statistics for every population and group, computed server-side.
+
+    Quartiles use numpy's default linear interpolation and the whiskers end at
+    the furthest values within 1.5 IQR of the box, as plotly computes them.
+    outliers keeps at most max_outliers values (always including the most
+    extreme two) and points a random sample of at most max_points values, so
+    the size of a chart built from a row does not grow with the data.
+    """
+    populations, matrix, labels = sample_matrix(long_df, group_column, value_column)
+    return box_summary_matrix(populations, matrix, labels, groups, max_outliers, max_points, seed)
+
+def box_summary_matrix(populations, matrix, labels, groups=None, max_outliers=50, max_points=0, seed=0):
+    """box_summary on a samples x populations matrix with one group label per sample."""
+    if groups is None:
+        groups = sorted(pd.unique(labels[pd.notna(labels)]))
+    rng = np.random.default_rng(seed)
+
+    rows = []
+    for group in groups:
+        values = matrix[labels == group]
+        if not len(values):
+            # an all-NaN row keeps the quantile shapes for a group without samples
+            values = np.full((1, len(populations)), np.nan)
+        n = np.count_nonzero(~np.isnan(values), axis=0)
+        with np.errstate(invalid='ignore'), warnings.catch_warnings():
+            # populations without any value in this group come back as NaN
+            warnings.simplefilter('ignore', RuntimeWarning)
+            q1, median, q3 = np.nanquantile(values, [0.25, 0.5, 0.75], axis=0)
+            iqr = q3 - q1
+            inside = (values >= q1 - 1.5 * iqr) & (values <= q3 + 1.5 * iqr)
+            lower_fence = np.nanmin(np.where(inside, values, np.nan), axis=0)
+            upper_fence = np.nanmax(np.where(inside, values, np.nan), axis=0)
+            mean = np.nanmean(values, axis=0)
+        outside = ~inside & ~np.isnan(values)
+        for i, population in enumerate(populations):
+            column = values[:, i]
+            outliers = column[outside[:, i]]
+            rows.append({
+                'population': population
+                , 'group': group
+                , 'n': n[i]
+                , 'q1': q1[i]
+                , 'median': median[i]
+                , 'q3': q3[i]
+                , 'lower_fence': lower_fence[i]
+                , 'upper_fence': upper_fence[i]
+                , 'mean': mean[i]
+                , 'n_outliers': len(outliers)
+                , 'outliers': _sample_values(rng, outliers, max_outliers, keep_extremes=True)
+                , 'points': _sample_values(rng, column[~np.isnan(column)], max_points)
+            })
+    return pd.DataFrame(rows, columns=BOX_COLUMNS)
@@ -0,0 +1,207 @@
+"""Synthetic cell-count data and benchmarks for ingestion, queries, Question 1 and Question 2.
+
+    python benchmark.py --scales 1000 10000 100000 --projects 300 -o bench.json
+    python benchmark.py --scales 1000 10000 100000 -o new.json --compare bench.json
+
+Every step runs in a fresh process so its peak RSS is its own. Results are
+written as JSON (with the git commit) so runs can be compared across commits.
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+import numpy as np
+import pandas as pd
+
+POPULATIONS = ['b_cell', 'cd8_t_cell', 'cd4_t_cell', 'nk_cell', 'monocyte']
+# mean share of each population, roughly matching data/cell-count.csv
+POPULATION_SHARES = np.array([0.27, 0.19, 0.29, 0.05, 0.14])
+TIMEPOINTS = np.array([0, 7, 14])
+GENERATE_CHUNK = 300_000  # multiple of len(TIMEPOINTS) so no subject straddles two chunks
+
+def generate_cell_counts(path, n_samples, n_projects=300, seed=0):
+    """Write a cell-count.csv shaped file with n_samples rows, three samples per subject."""
+    samples_per_subject = len(TIMEPOINTS)
+    with open(path, 'w', newline='') as f:
+        for chunk_index, first in enumerate(range(0, n_samples, GENERATE_CHUNK)):
+            rng = np.random.default_rng([seed, chunk_index])
+            n = min(GENERATE_CHUNK, n_samples - first)
+            sample_index = np.arange(first, first + n)
+            subject_index = sample_index // samples_per_subject
+            first_subject = subject_index[0]
+            n_subjects = subject_index[-1] - first_subject + 1
+            local = subject_index - first_subject
+
+            project = rng.integers(1, n_projects + 1, n_subjects)
+            condition = rng.choice(np.array(['melanoma', 'lung', 'healthy'], dtype=object), n_subjects, p=[0.4, 0.3, 0.3])
+            healthy = condition == 'healthy'
+            treatment = np.where(healthy, 'none', rng.choice(np.array(['tr1', 'tr2'], dtype=object), n_subjects, p=[0.7, 0.3]))
+            response = np.where(healthy, '', rng.choice(np.array(['y', 'n'], dtype=object), n_subjects))
+            age = rng.integers(20, 86, n_subjects)
+            sex = rng.choice(np.array(['F', 'M'], dtype=object), n_subjects)
+
+            timepoint = TIMEPOINTS[sample_index % samples_per_subject].astype(object)
+            timepoint[healthy[local]] = ''
+            shares = rng.gamma(POPULATION_SHARES * 40, size=(n, len(POPULATIONS)))
+            shares /= shares.sum(axis=1, keepdims=True)
+            totals = rng.lognormal(np.log(100_000), 0.25, n)
+
+            chunk = pd.DataFrame({
+                'project': np.char.add('prj', project.astype(str))[local]
+                , 'subject': np.char.add('sbj', (subject_index + 1).astype(str))
+                , 'condition': condition[local]
+                , 'age': age[local]
+                , 'sex': sex[local]
+                , 'treatment': treatment[local]
+                , 'response': response[local]
+                , 'sample': np.char.add('s', (sample_index + 1).astype(str))
+                , 'sample_type': rng.choice(np.array(['PBMC', 'tumor'], dtype=object), n, p=[0.85, 0.15])
+                , 'time_from_treatment_start': timepoint
+            })
+            counts = np.rint(shares * totals[:, None]).astype(np.int64)
+            for i, population in enumerate(POPULATIONS):
+                chunk[population] = counts[:, i]
+            chunk.to_csv(f, index=False, header=chunk_index == 0)
+    return path
+
+def _peak_rss_mb():
+    # ru_maxrss is KiB on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+def _run_step(name, csv_path, db_path):
+    # runs in a fresh process: setup is excluded from the timing, the step itself is not
+    import database
+    from batch_stats import compare_groups
+    from frequency import relative_frequency
+    from pool import get_pool
+    from resampling import compare_resampled
+
+    if name == 'init_db':
+        start = time.perf_counter()
+        stats = database.init_db(csv_path, db_path)
+        seconds = time.perf_counter() - start
+        rows = stats['rows']
+    elif name.endswith('_query'):
+        query = getattr(database, name)
+        params = getattr(database, name.replace('_query', '_params'), ())
+        with get_pool(db_path).reader() as sqlite_conn:
+            start = time.perf_counter()
+            rows = len(sqlite_conn.execute(query, params).fetchall())
+            seconds = time.perf_counter() - start
+    else:
+        cell_count_df = pd.read_csv(csv_path)
+        if name == 'q1_transform':
+            start = time.perf_counter()
+            rows = len(relative_frequency(cell_count_df))
+            seconds = time.perf_counter() - start
+        elif name in ('q2_statistics', 'q2_resampling'):
+            melted_rf = relative_frequency(cell_count_df)
+            cohort = melted_rf[(melted_rf['treatment'] == 'tr1') & (melted_rf['condition'] == 'melanoma')
+                               & (melted_rf['sample_type'] == 'PBMC')]
+            start = time.perf_counter()
+            if name == 'q2_statistics':
+                compare_groups(cohort, 'response', ('y', 'n'))
+            else:
+                compare_resampled(cohort, 'response', ('y', 'n'), n_permutations=RESAMPLES, n_bootstrap=RESAMPLES)
+            seconds = time.perf_counter() - start
+            rows = len(cohort)
+        elif name == 'q2_longitudinal':
+            from cube import CountCube
+            from longitudinal import cube_trajectories
+            cube = CountCube(cell_count_df)
+            mask = cube.mask((('treatment', 'tr1'), ('condition', 'melanoma'), ('sample_type', 'PBMC')))
+            start = time.perf_counter()
+            trajectories = cube_trajectories(cube, mask)
+            trajectories.summary(('y', 'n'))
+            trajectories.compare_timepoints(('y', 'n'))
+            trajectories.compare_auc(('y', 'n'))
+            seconds = time.perf_counter() - start
+            rows = int(mask.sum())
+        else:
+            raise ValueError(f'unknown benchmark step {name}')
+    return {
+        'seconds': seconds
+        , 'rows': rows
+        , 'rows_per_sec': rows / seconds if seconds else None
+        , 'peak_rss_mb': _peak_rss_mb()
+    }
+
+STEPS = ['init_db', 'q3_query', 'q4_query', 'q5a_query', 'q5b_query', 'q5c_query', 'q1_transform', 'q2_statistics'
+         , 'q2_resampling', 'q2_longitudinal']
+# permutations and bootstrap resamples in the q2_resampling step
+RESAMPLES = 100_000
+
+def run_benchmarks(scales, n_projects=300, steps=STEPS, seed=0, workdir=None):
+    results = []
+    with tempfile.TemporaryDirectory(dir=workdir) as tmp:
+        for scale in scales:
+            csv_path = os.path.join(tmp, f'cell-count-{scale}.csv')
+            db_path = os.path.join(tmp, f'bench-{scale}.sqlite')
+            start = time.perf_counter()
+            generate_cell_counts(csv_path, scale, n_projects, seed)
+            print(f'generated {scale:,} samples in {time.perf_counter() - start:.1f}s', file=sys.stderr)
+            for step in steps:
+                # init_db must run first at every scale; the queries read the database it builds
+                with ProcessPoolExecutor(1, mp_context=get_context('spawn')) as executor:
+                    result = executor.submit(_run_step, step, csv_path, db_path).result()
+                result = dict(step=step, scale=scale, **result)
+                print(f"{step:>14} @ {scale:>10,}: {result['seconds']:8.3f}s {result['peak_rss_mb']:8.1f} MB", file=sys.stderr)
+                results.append(result)
+    return results
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(results, baseline):
+    """Print the time and memory ratio of every step against a previous run."""
+    previous = {(r['step'], r['scale']): r for r in baseline['results']}
+    for r in results:
+        old = previous.get((r['step'], r['scale']))
+        if old and old['seconds']:
+            print(f"{r['step']:>14} @ {r['scale']:>10,}: time x{r['seconds'] / old['seconds']:.2f}"
+                  f"  rss x{r['peak_rss_mb'] / old['peak_rss_mb']:.2f}")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark ingestion, queries and analysis on synthetic data.')
+    parser.add_argument('--scales', type=int, nargs='+', default=[1_000, 10_000, 100_000], help='samples per run')
+    parser.add_argument('--projects', type=int, default=300)
+    parser.add_argument('--steps', nargs='+', default=STEPS, choices=STEPS)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workdir', default=None, help='where generated csv/sqlite files go (default: system tmp)')
+    parser.add_argument('-o', '--output', default='benchmark-results.json')
+    parser.add_argument('--compare', default=None, help='earlier results JSON to compare against')
+    parser.add_argument('--generate-only', default=None, metavar='CSV', help='only write a synthetic csv of the first scale')
+    args = parser.parse_args(argv)
+
+    if args.generate_only:
+        generate_cell_counts(args.generate_only, args.scales[0], args.projects, args.seed)
+        return
+
+    results = run_benchmarks(args.scales, args.projects, args.steps, args.seed, args.workdir)
+    report = {
+        'commit': _git_commit()
+        , 'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z')
+        , 'python': platform.python_version()
+        , 'machine': platform.machine()
+        , 'cpus': os.cpu_count()
+        , 'results': results
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+import os
+import re
+import threading
+from collections import OrderedDict
+
+# default budget for cached query results, overridable per deployment
+DEFAULT_MAX_BYTES = int(os.environ.get('RESULT_CACHE_MB', 64)) * 1024 * 1024
+
+# string literals are kept verbatim, whitespace outside them collapses to one space
+_SQL_TOKEN = re.compile(r"""('(?:[^']|'')*'|"(?:[^"]|"")*")|\s+""")
+
+def normalize_sql(sql):
+    return _SQL_TOKEN.sub(lambda m: m.group(1) or ' ', sql).strip().rstrip(';').strip()
+
+def result_size(result):
+    if hasattr(result, 'memory_usage'):
+        return int(result.memory_usage(index=True, deep=True).sum())
+    return len(repr(result))
+
+class ResultCache:
+    """Process-wide LRU cache of query results, bounded by total size in bytes.
+
+    Entries are keyed by normalized SQL, its bound parameters and the
+    database's data version, so a new ingest makes every older entry
+    unreachable; those age out through the LRU. Cached results are shared
+    between sessions and must not be mutated.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.current_bytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, sql, version, params=()):
+        key = (normalize_sql(sql), tuple(params), version)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, sql, version, result, params=()):
+        key = (normalize_sql(sql), tuple(params), version)
+        size = result_size(result)
+        if size > self.max_bytes:
+            return result
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.current_bytes -= old[1]
+            self._entries[key] = (result, size)
+            self.current_bytes += size
+            while self.current_bytes > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.current_bytes -= evicted_size
+                self.evictions += 1
+        return result
+
+    def get_or_run(self, sql, version, run, params=()):
+        # run() is only called on a miss; two sessions missing at once may both
+        # run it, which costs a duplicate query but never blocks on the lock
+        result = self.get(sql, version, params)
+        if result is None:
+            result = self.put(sql, version, run(), params)
+        return result
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits
+                , 'misses': self.misses
+                , 'evictions': self.evictions
+                , 'entries': len(self._entries)
+                , 'bytes': self.current_bytes
+                , 'max_bytes': self.max_bytes
+            }
+
+result_cache = ResultCache()
@@ -0,0 +1,188 @@
+"""Bound-parameter SQL for any cohort of samples, joining only the tables it uses.
+
+    sql, params = cohort_sql({'sample_type': 'PBMC', 'treatment': 'tr1', 'time_from_treatment_start': (0, 0)}
+                             , group_by=['response'])
+    sqlite_conn.execute(sql, params)
+
+Filter values are always bound, never spliced into the text, and filters and
+joins are emitted in a fixed order. The same cohort shape with other values is
+therefore the same SQL string, so sqlite3's per-connection statement cache
+(see pool.STATEMENT_CACHE_SIZE) reuses the prepared statement.
+
+With table, the samples are read from that denormalized table instead (the
+cohort table database.init_db materializes, one row per sample, condition
+and treatment with every dimension as a column), so no join is needed except
+for cell counts.
+"""
+
+# dimension -> (column expression, result column name, table aliases it needs)
+DIMENSIONS = {
+    'project': ('p.project_name', 'project_name', ('su', 'p'))
+    , 'subject': ('su.subject_name', 'subject_name', ('su',))
+    , 'sex': ('su.sex', 'sex', ('su',))
+    , 'condition': ('c.condition_name', 'condition_name', ('sc', 'c'))
+    , 'treatment': ('t.treatment_name', 'treatment_name', ('st', 't'))
+    , 'response': ('st.response', 'response', ('st',))
+    , 'sample_type': ('sa.sample_type', 'sample_type', ())
+    , 'time_from_treatment_start': ('sa.time_from_treatment_start', 'time_from_treatment_start', ())
+}
+# filters a cohort accepts; time_from_treatment_start takes a (low, high) range, the rest values
+FILTERS = ['sample_type', 'time_from_treatment_start', 'project', 'sex', 'condition', 'treatment', 'response']
+
+# alias -> (table, join condition), in the order they are joined
+_JOINS = {
+    'su': ('subject su', 'su.subject_id = sa.subject_id')
+    , 'p': ('project p', 'p.project_id = su.project_id')
+    , 'sc': ('subject_condition sc', 'sc.subject_id = sa.subject_id')
+    , 'c': ('condition c', 'c.condition_id = sc.condition_id')
+    , 'st': ('subject_treatment st', 'st.subject_id = sa.subject_id')
+    , 't': ('treatment t', 't.treatment_id = st.treatment_id')
+}
+# subjects can have several conditions and treatments, so these joins repeat samples
+# unless a filter pins them to a single value
+_FAN_OUT = {'sc': 'condition', 'st': 'treatment'}
+
+_SAMPLE_COLUMNS = ['sa.sample_id', 'sa.subject_id', 'sa.sample_type', 'c.condition_name', 't.treatment_name'
+                   , 'sa.time_from_treatment_start']
+
+def _values(value):
+    if value is None:
+        return []
+    if isinstance(value, (list, tuple, set, frozenset)):
+        # sorted so the same set of values always binds in the same order
+        return sorted(set(value), key=lambda v: (v is not None, str(v)))
+    return [value]
+
+def _condition(expression, values, params):
+    # None among the values matches missing rows, e.g. subjects without a condition
+    present = [v for v in values if v is not None]
+    terms = []
+    if len(present) == 1:
+        terms.append(f'{expression} = ?')
+    elif present:
+        terms.append(f"{expression} in ({', '.join('?' * len(present))})")
+    if len(present) < len(values):
+        terms.append(f'{expression} is null')
+    params.extend(present)
+    return terms[0] if len(terms) == 1 else f"({' or '.join(terms)})"
+
+def _range(expression, bounds, params):
+    low, high = bounds
+    if low is not None and low == high:
+        params.append(low)
+        return f'{expression} = ?'
+    terms = []
+    if low is not None:
+        terms.append(f'{expression} >= ?')
+        params.append(low)
+    if high is not None:
+        terms.append(f'{expression} <= ?')
+        params.append(high)
+    return ' and '.join(terms)
+
+def cohort_sql(filters=None, group_by=(), cell_counts=False, limit=None, table=None):
+    """SQL and parameters selecting the samples matching filters.
+
+    filters maps names in FILTERS to a value or a list of values (None matches
+    a missing value); time_from_treatment_start takes a (low, high) range with
+    None for an open end. With group_by (names in DIMENSIONS) each row counts
+    the samples and subjects of one group; otherwise there is one row per
+    sample, condition and treatment, or per cell type as well with cell_counts.
+    limit caps the number of rows returned. table reads a denormalized cohort
+    table (see the module docstring) instead of joining the base tables.
+    """
+    filters = filters or {}
+    unknown = set(filters) - set(FILTERS) or set(group_by) - set(DIMENSIONS)
+    if unknown:
+        raise ValueError(f"unknown cohort dimension(s): {', '.join(sorted(map(str, unknown)))}")
+
+    alias = 'co' if table else 'sa'
+    if table:
+        # every dimension is a column of the table, named like the result column
+        dimensions = {name: (f'co.{column}', column, ()) for name, (_, column, _) in DIMENSIONS.items()}
+    else:
+        dimensions = DIMENSIONS
+
+    params = []
+    where = []
+    pinned = set()
+    filtered_tables = set()
+    needed = set()
+    for name in FILTERS:
+        value = filters.get(name)
+        expression, _, tables = dimensions[name]
+        if name == 'time_from_treatment_start':
+            if value is None or value == (None, None):
+                continue
+            where.append(_range(expression, value, params))
+        else:
+            values = _values(value)
+            if not values:
+                continue
+            where.append(_condition(expression, values, params))
+            if len(values) == 1 and values[0] is not None:
+                pinned.add(name)
+            if None not in values:
+                # an inner join lets the planner start from this table's index
+                filtered_tables.update(tables)
+        needed.update(tables)
+
+    if table:
+        # the table holds every condition and treatment of a sample's subject
+        fanned_out = set(_FAN_OUT.values())
+    else:
+        if group_by:
+            for name in group_by:
+                needed.update(DIMENSIONS[name][2])
+        else:
+            needed.update(('sc', 'c', 'st', 't'))
+        fanned_out = {dimension for table_alias, dimension in _FAN_OUT.items() if table_alias in needed}
+
+    joins = []
+    for join_alias, (join_table, on) in _JOINS.items():
+        if join_alias in needed:
+            kind = 'join' if join_alias == 'su' or join_alias in filtered_tables else 'left join'
+            joins.append(f'{kind} {join_table}\n    on {on}')
+
+    if group_by:
+        columns = [dimensions[name][0] for name in group_by]
+        repeats = bool(fanned_out - pinned)
+        columns.append(f'count(distinct {alias}.sample_id) num_sample' if repeats else 'count(*) num_sample')
+        columns.append(f'count(distinct {alias}.subject_id) num_subject')
+        group_columns = ', '.join(DIMENSIONS[name][1] for name in group_by)
+        tail = f'group by {group_columns}\norder by {group_columns}'
+    else:
+        # the table's columns are named like the base tables' ones
+        columns = [f"co.{column.split('.')[1]}" for column in _SAMPLE_COLUMNS] if table else list(_SAMPLE_COLUMNS)
+        tail = f'order by {alias}.sample_id'
+        if cell_counts:
+            columns += ['ct.cell_type_name', 'cc.cell_count']
+            joins += [f'left join cell_count cc\n    on cc.sample_id = {alias}.sample_id'
+                      , 'left join cell_type ct\n    on ct.cell_type_id = cc.cell_type_id']
+            tail += ', ct.cell_type_name'
+
+    sql = 'select ' + '\n    , '.join(columns) + f"\nfrom {table or 'sample'} {alias}"
+    for join in joins:
+        sql += '\n' + join
+    if where:
+        sql += '\nwhere ' + '\n    and '.join(where)
+    sql += '\n' + tail
+    if limit is not None:
+        sql += '\nlimit ?'
+        params.append(limit)
+    return sql, params
+
+def filter_options(sqlite_conn):
+    """Values each filter can take in the database, for building a cohort picker."""
+    def column(sql):
+        return [row[0] for row in sqlite_conn.execute(sql)]
+    low, high = sqlite_conn.execute("select min(time_from_treatment_start), max(time_from_treatment_start) from sample").fetchone()
+    return {
+        'sample_type': column("select distinct sample_type from sample where sample_type is not null order by 1")
+        , 'project': column("select project_name from project order by 1")
+        , 'sex': column("select distinct sex from subject where sex is not null order by 1")
+        , 'condition': column("select condition_name from condition order by 1")
+        , 'treatment': column("select treatment_name from treatment order by 1")
+        , 'response': column("select distinct response from subject_treatment where response is not null order by 1")
+        , 'time_from_treatment_start': (low, high)
+    }
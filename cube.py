@@ -0,0 +1,104 @@
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+from database import population_columns
+from frequency import percentages
+
+# metadata stored as integer codes into per-column categories (-1 = missing)
+CODED_COLUMNS = ['project', 'subject', 'condition', 'sex', 'treatment', 'response', 'sample_type'
+                 , 'time_from_treatment_start']
+# columns with at most this many values get a precomputed bitmap per value; others (subject and,
+# at scale, project) are compared against their codes when filtered on. A column's bitmaps cost
+# n_values / 8 bytes per sample against 4 for its int32 codes, so they stop paying off past 32 values.
+MAX_BITMAP_VALUES = 32
+
+def _read_only(array):
+    array.flags.writeable = False
+    return array
+
+def _factorize(column):
+    """Integer codes (-1 = missing) and categories of a pyarrow column, read from its dictionary."""
+    if not pa.types.is_dictionary(column.type):
+        # one memo table across chunks, so every chunk shares the dictionary
+        column = pc.dictionary_encode(column)
+    if not column.num_chunks:
+        return np.empty(0, dtype=np.int32), pd.Index([])
+    dictionary = column.chunk(0).dictionary
+    if not all(chunk.dictionary.equals(dictionary) for chunk in column.chunks[1:]):
+        # snapshots already share one dictionary per column; other tables may not
+        column = pa.table({'column': column}).unify_dictionaries()['column']
+        dictionary = column.chunk(0).dictionary
+    codes = np.concatenate([pc.fill_null(chunk.indices, -1).to_numpy() for chunk in column.chunks])
+    return codes.astype(np.int32, copy=False), pd.Index(dictionary.to_pandas())
+
+class CountCube:
+    """Read-only samples x populations counts with integer-coded metadata.
+
+    Built once per data version and shared by every session. Cohorts are
+    selected by AND-ing packed bitmaps (one bit per sample per metadata value,
+    for columns with up to MAX_BITMAP_VALUES values; codes are compared for
+    the rest), so filtering never copies a DataFrame; callers index the
+    matrices with the resulting mask. All arrays are marked read-only.
+    """
+
+    def __init__(self, table):
+        # a pyarrow Table (e.g. the memory-mapped snapshot) is read column by column without a
+        # pandas copy of the whole table; a DataFrame is converted first
+        if isinstance(table, pd.DataFrame):
+            table = pa.Table.from_pandas(table, preserve_index=False)
+        self.populations = population_columns(table.column_names)
+        self.samples = _read_only(table['sample'].to_numpy().astype(object, copy=False))
+        self.n_samples = len(self.samples)
+        self.counts = _read_only(np.ascontiguousarray(
+            np.column_stack([table[p].to_numpy() for p in self.populations]).astype(np.int64, copy=False)
+            if self.populations else np.empty((self.n_samples, 0), dtype=np.int64)))
+        self.total_count = _read_only(self.counts.sum(axis=1))
+        # the same arithmetic as the Question 1 table and its exports
+        self.percentages = _read_only(percentages(self.counts, self.total_count))
+
+        self.codes = {}
+        self.categories = {}
+        self._bitmaps = {}
+        for column in CODED_COLUMNS:
+            if column not in table.column_names:
+                continue
+            codes, categories = _factorize(table[column])
+            self.codes[column] = _read_only(codes)
+            self.categories[column] = categories
+            if len(categories) <= MAX_BITMAP_VALUES:
+                self._bitmaps[column] = [_read_only(np.packbits(codes == code)) for code in range(len(categories))]
+        self.age = _read_only(table['age'].to_numpy()) if 'age' in table.column_names else None
+
+    def bitmap(self, column, value):
+        """Packed bits of the samples whose column equals value (None matches missing values)."""
+        if value is None:
+            return np.packbits(self.codes[column] == -1)
+        code = self.categories[column].get_indexer([value])[0]
+        if code == -1:
+            return np.zeros((self.n_samples + 7) // 8, dtype=np.uint8)
+        if column in self._bitmaps:
+            return self._bitmaps[column][code]
+        return np.packbits(self.codes[column] == code)
+
+    def mask(self, filters=()):
+        """Boolean sample mask for a tuple of (column, value) filters, all of which must hold."""
+        bits = np.full((self.n_samples + 7) // 8, 0xFF, dtype=np.uint8)
+        for column, value in filters:
+            np.bitwise_and(bits, self.bitmap(column, value), out=bits)
+        return np.unpackbits(bits, count=self.n_samples).view(bool)
+
+    def values(self, column, mask=None):
+        """Decoded values of a coded column (NaN where missing), optionally for the masked samples only."""
+        codes = self.codes[column] if mask is None else self.codes[column][mask]
+        return pd.Categorical.from_codes(codes, categories=self.categories[column]).to_numpy(dtype=object, na_value=np.nan)
+
+    def count_unique(self, column, mask):
+        """Number of distinct values of column among the masked samples."""
+        codes = self.codes[column][mask]
+        return len(np.unique(codes[codes >= 0]))
+
+    def nbytes(self):
+        arrays = [self.samples, self.counts, self.total_count, self.percentages, *self.codes.values()]
+        arrays += [bitmap for bitmaps in self._bitmaps.values() for bitmap in bitmaps]
+        return sum(a.nbytes for a in arrays)
@@ -1,212 +1,279 @@
+import hashlib
+import os
 import sqlite3
+import time
+import numpy as np
 import pandas as pd
+from cohort_query import cohort_sql
+from pool import get_pool
 
-def init_db(cell_count_df):
-    sqlite_conn = sqlite3.connect("demo_db.sqlite")
-    sqlite_cursor = sqlite_conn.cursor()
-    schema_sql = """
-    -- Project table
-    DROP TABLE IF EXISTS project;
-    CREATE TABLE project (
-        project_id INTEGER PRIMARY KEY AUTOINCREMENT,
-        project_name TEXT NOT NULL,
-        project_description TEXT
-    );
-
-    INSERT INTO project (project_name, project_description)
-    VALUES ('prj1', 'Project 1'),('prj2', 'Project 2'),('prj3', 'Project 3');
-
-    -- subject table
-    DROP TABLE IF EXISTS subject;
-    CREATE TABLE subject (
-        subject_id INTEGER PRIMARY KEY AUTOINCREMENT,
-        project_id INTEGER NOT NULL,
-        sex TEXT CHECK(sex IN ('F', 'M')),
-        date_of_birth DATE,
-        FOREIGN KEY (project_id) REFERENCES project(project_id)
-    );
-
-    INSERT INTO subject (project_id, sex, date_of_birth)
-    VALUES (1, 'F', '1955-05-01') --70 years
-    , (1, 'F', '1960-05-01')
-    , (1, 'M', '1950-05-01')
-    , (1, 'F', '1965-05-01')
-    , (1, 'M', '1948-05-01')
-    , (2, 'M', '1980-05-01')
-    , (2, 'F', '1945-05-01')
-    , (2, 'F', '1995-05-01')
-    , (2, 'M', '1953-05-01')
-    , (2, 'M', '1963-05-01')
-    , (2, 'F', '1970-05-01')
-    , (3, 'F', '1975-05-01')
-    , (3, 'M', '1975-05-01')
-    ;
-
-    -- condition table
-    DROP TABLE IF EXISTS condition;
-    CREATE TABLE condition (
-        condition_id INTEGER PRIMARY KEY AUTOINCREMENT,
-        condition_name TEXT NOT NULL
-    );
-
-    INSERT INTO condition (condition_name)
-    VALUES ('melanoma'), ('lung')
-    ;
-
-    -- Subject-Condition table (join table)
-    DROP TABLE IF EXISTS subject_condition;
-    CREATE TABLE subject_condition (
-        subject_id INTEGER,
-        condition_id INTEGER,
-        date_diagnosed DATE,
-        date_remission DATE,
-        FOREIGN KEY (subject_id) REFERENCES subject(subject_id),
-        FOREIGN KEY (condition_id) REFERENCES condition(condition_id),
-        PRIMARY KEY (subject_id, condition_id)
-    );
-
-    INSERT INTO subject_condition (subject_id, condition_id, date_diagnosed)
-    VALUES (1, 1, '2025-04-30')
-    , (3, 1, '2025-04-30')
-    , (4, 2, '2025-04-30')
-    , (8, 1, '2025-04-30')
-    , (9, 1, '2025-04-30')
-    , (10, 2, '2025-04-30')
-    , (11, 2, '2025-04-30')
-    , (12, 1, '2025-04-30')
-    , (13, 1, '2025-04-30')
-    ;
-
-    -- treatment table
-    DROP TABLE IF EXISTS treatment;
-    CREATE TABLE treatment (
-        treatment_id INTEGER PRIMARY KEY AUTOINCREMENT,
-        treatment_name TEXT NOT NULL,
-        treatment_description TEXT
-    );
-
-    INSERT INTO treatment (treatment_name, treatment_description)
-    VALUES ('tr1', 'Treatment 1'), ('tr2', 'Treatment 2');
-
-    -- Subject-treatment table (join table)
-    DROP TABLE IF EXISTS subject_treatment;
-    CREATE TABLE subject_treatment (
-        subject_id INTEGER,
-        treatment_id INTEGER,
-        response TEXT CHECK(response IN ('y', 'n')),
-        FOREIGN KEY (subject_id) REFERENCES subject(subject_id),
-        FOREIGN KEY (treatment_id) REFERENCES treatment(treatment_id),
-        PRIMARY KEY (subject_id, treatment_id)
-    );
-
-    INSERT INTO subject_treatment (subject_id, treatment_id, response)
-    VALUES (1,1,'y')
-    , (3,1,'n')
-    , (4,2,'y')
-    , (8,1,'y')
-    , (9,1,'y')
-    , (10,1,'n')
-    , (11,1,'n')
-    , (12,1,'n')
-    , (13,1,'y')
-    ;
-
-    -- sample table
-    DROP TABLE IF EXISTS sample;
-    CREATE TABLE sample (
-        sample_id INTEGER PRIMARY KEY AUTOINCREMENT,
-        subject_id INTEGER NOT NULL,
-        sample_type TEXT,
-        time_from_treatment_start INTEGER,
-        FOREIGN KEY (subject_id) REFERENCES subject(subject_id)
-    );
-
-    -- Cell Types table
-    DROP TABLE IF EXISTS cell_type;
-    CREATE TABLE cell_type (
-        cell_type_id INTEGER PRIMARY KEY AUTOINCREMENT,
-        cell_type_name TEXT NOT NULL,
-        cell_type_description TEXT
-    );
-
-    INSERT INTO cell_type (cell_type_name, cell_type_description)
-    VALUES ('b_cell', 'b_cell')
-    , ('cd8_t_cell', 'cd8_t_cell')
-    , ('cd4_t_cell', 'cd4_t_cell')
-    , ('nk_cell', 'nk_cell')
-    , ('monocyte', 'monocyte')
-    ;
-
-    -- Cell Counts table
-    DROP TABLE IF EXISTS cell_count;
-    CREATE TABLE cell_count (
-        sample_id INTEGER NOT NULL,
-        cell_type_id INTEGER NOT NULL,
-        cell_count INTEGER,
-        PRIMARY KEY (sample_id, cell_type_id),
-        FOREIGN KEY (sample_id) REFERENCES sample(sample_id),
-        FOREIGN KEY (cell_type_id) REFERENCES cell_type(cell_type_id)
-    );
-    """
-    
-    sample = []
-    cell = []
-    for i,r in cell_count_df.iterrows():
-        subject_id = int(r['subject'][3:])
-        if not pd.isna(r['time_from_treatment_start']):
-            sample.append([subject_id, r['sample_type'], r['time_from_treatment_start']])
-
-        cell.append([i+1, 1, r['b_cell']])
-        cell.append([i+1, 2, r['cd8_t_cell']])
-        cell.append([i+1, 3, r['cd4_t_cell']])
-        cell.append([i+1, 4, r['nk_cell']])
-        cell.append([i+1, 5, r['monocyte']])
-
-    insert_sample_query = f"""
-    INSERT INTO sample (subject_id, sample_type, time_from_treatment_start)
-    VALUES {','.join(f"({s[0]}, '{s[1]}', {s[2]})" for s in sample)}
-    """
+DB_PATH = "demo_db.sqlite"
+CHUNK_SIZE = 50_000
 
-    insert_cell_query = f"""
-    INSERT INTO cell_count (sample_id , cell_type_id, cell_count)
-    VALUES {','.join(f"({c[0]}, {c[1]}, {c[2]})" for c in cell)}
-    """
+# every other column in the csv is treated as a cell population count
+META_COLUMNS = ['project', 'subject', 'condition', 'age', 'sex', 'treatment', 'response'
+                , 'sample', 'sample_type', 'time_from_treatment_start']
 
-    sqlite_cursor.executescript(schema_sql)
-    sqlite_cursor.executescript(insert_sample_query)
-    sqlite_cursor.executescript(insert_cell_query)
-    sqlite_conn.commit()
+# csv placeholders meaning "no condition" / "no treatment" rather than real dimension rows
+NO_CONDITION = 'healthy'
+NO_TREATMENT = 'none'
 
-q3_query = """
-select
-    c.condition_name
-    , count(distinct s.subject_id) as unique_patients
-    , count(distinct case when st.response = 'y' then st.subject_id end) as responders
-    , count(distinct case when st.response = 'n' then st.subject_id end) as non_responders
-    , round(avg(strftime('%Y %m %d',date('now')) - strftime('%Y %m %d',s.date_of_birth)),2) average_age
-from subject s
-left join subject_condition sc
-    on sc.subject_id = s.subject_id 
-left join condition c
-    on c.condition_id= sc.condition_id
-left join subject_treatment st
-    on s.subject_id = st.subject_id
-left join treatment t
-    on t.treatment_id = st.treatment_id
-group by c.condition_name"""
+# the only values the CHECK constraints in schema_sql accept
+SEX_VALUES = ('F', 'M')
+RESPONSE_VALUES = ('y', 'n')
+
+# the csv only carries age, so date_of_birth is derived relative to this date
+AGE_REFERENCE_DATE = '2025-05-01'
+
+# bump whenever schema_sql changes so existing database files get rebuilt
+SCHEMA_VERSION = 5
+
+# last known data version per database file, kept in memory so cache lookups
+# can be keyed on it without querying sqlite
+_data_versions = {}
+# the generation file each database path pointed at when its version was read, so a
+# swap published by another process (e.g. directory_ingest.py) is noticed
+_published_files = {}
+
+schema_sql = """
+-- Project table
+DROP TABLE IF EXISTS project;
+CREATE TABLE project (
+    project_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    project_name TEXT NOT NULL UNIQUE,
+    project_description TEXT
+);
+
+-- subject table
+DROP TABLE IF EXISTS subject;
+CREATE TABLE subject (
+    subject_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    subject_name TEXT NOT NULL UNIQUE,
+    project_id INTEGER NOT NULL,
+    sex TEXT CHECK(sex IN ('F', 'M')),
+    date_of_birth DATE,
+    FOREIGN KEY (project_id) REFERENCES project(project_id)
+);
+
+-- condition table
+DROP TABLE IF EXISTS condition;
+CREATE TABLE condition (
+    condition_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    condition_name TEXT NOT NULL UNIQUE
+);
+
+-- Subject-Condition table (join table)
+DROP TABLE IF EXISTS subject_condition;
+CREATE TABLE subject_condition (
+    subject_id INTEGER,
+    condition_id INTEGER,
+    date_diagnosed DATE,
+    date_remission DATE,
+    FOREIGN KEY (subject_id) REFERENCES subject(subject_id),
+    FOREIGN KEY (condition_id) REFERENCES condition(condition_id),
+    PRIMARY KEY (subject_id, condition_id)
+);
+
+-- treatment table
+DROP TABLE IF EXISTS treatment;
+CREATE TABLE treatment (
+    treatment_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    treatment_name TEXT NOT NULL UNIQUE,
+    treatment_description TEXT
+);
+
+-- Subject-treatment table (join table)
+DROP TABLE IF EXISTS subject_treatment;
+CREATE TABLE subject_treatment (
+    subject_id INTEGER,
+    treatment_id INTEGER,
+    response TEXT CHECK(response IN ('y', 'n')),
+    FOREIGN KEY (subject_id) REFERENCES subject(subject_id),
+    FOREIGN KEY (treatment_id) REFERENCES treatment(treatment_id),
+    PRIMARY KEY (subject_id, treatment_id)
+);
+
+-- sample table
+DROP TABLE IF EXISTS sample;
+CREATE TABLE sample (
+    sample_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    sample_name TEXT NOT NULL UNIQUE,
+    subject_id INTEGER NOT NULL,
+    sample_type TEXT,
+    time_from_treatment_start INTEGER,
+    FOREIGN KEY (subject_id) REFERENCES subject(subject_id)
+);
+
+-- Cell Types table
+DROP TABLE IF EXISTS cell_type;
+CREATE TABLE cell_type (
+    cell_type_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    cell_type_name TEXT NOT NULL UNIQUE,
+    cell_type_description TEXT
+);
+
+-- Cell Counts table
+DROP TABLE IF EXISTS cell_count;
+CREATE TABLE cell_count (
+    sample_id INTEGER NOT NULL,
+    cell_type_id INTEGER NOT NULL,
+    cell_count INTEGER,
+    PRIMARY KEY (sample_id, cell_type_id),
+    FOREIGN KEY (sample_id) REFERENCES sample(sample_id),
+    FOREIGN KEY (cell_type_id) REFERENCES cell_type(cell_type_id)
+);
+
+-- Indexes for the cohort access paths (reverse keys of the join tables)
+CREATE INDEX subject_project_idx ON subject (project_id);
+CREATE INDEX subject_condition_condition_idx ON subject_condition (condition_id, subject_id);
+CREATE INDEX subject_treatment_treatment_idx ON subject_treatment (treatment_id, response, subject_id);
+CREATE INDEX sample_subject_idx ON sample (subject_id, sample_type, time_from_treatment_start);
+CREATE INDEX sample_type_time_idx ON sample (sample_type, time_from_treatment_start, subject_id);
+"""
+
+# Per-condition subject summary behind q3, kept current by triggers on subject,
+# subject_condition and subject_treatment so q3 reads one row per condition.
+# condition_id 0 collects subjects without any condition ("healthy").
+# A subject counts in every condition it has, or in bucket 0 when it has none.
+
+def _subject_buckets(subject_id):
+    return f"""condition_id IN (
+        SELECT condition_id FROM subject_condition WHERE subject_id = {subject_id}
+        UNION ALL
+        SELECT 0 WHERE NOT EXISTS (SELECT 1 FROM subject_condition WHERE subject_id = {subject_id}))"""
+
+def _birth_year(date_of_birth):
+    return f"coalesce(CAST(strftime('%Y', {date_of_birth}) AS INTEGER), 0)"
+
+def _summary_delta(sign, subject_id, where, date_of_birth=None):
+    # add (sign '+') or remove (sign '-') one subject's contribution to the matching summary rows
+    if date_of_birth is None:
+        date_of_birth = f"(SELECT date_of_birth FROM subject WHERE subject_id = {subject_id})"
+    return f"""
+    UPDATE condition_summary SET
+        subjects = subjects {sign} 1
+        , responders = responders {sign} coalesce((SELECT yes_responses > 0 FROM subject_summary WHERE subject_id = {subject_id}), 0)
+        , non_responders = non_responders {sign} coalesce((SELECT no_responses > 0 FROM subject_summary WHERE subject_id = {subject_id}), 0)
+        , birth_year_sum = birth_year_sum {sign} {_birth_year(date_of_birth)}
+        , birth_year_count = birth_year_count {sign} ({date_of_birth} IS NOT NULL)
+    WHERE {where};"""
+
+def _response_delta(sign, subject_id, response, when_count_is):
+    # a subject becomes (or stops being) a responder when its count of y responses leaves (or reaches) zero
+    return "".join(f"""
+    UPDATE condition_summary SET {column} = {column} {sign} 1
+    WHERE {response} IS '{value}'
+        AND (SELECT {count} FROM subject_summary WHERE subject_id = {subject_id}) = {when_count_is}
+        AND {_subject_buckets(subject_id)};""" for column, count, value in [
+        ('responders', 'yes_responses', 'y'), ('non_responders', 'no_responses', 'n')])
+
+def _response_count(sign, subject_id, response):
+    return f"""
+    UPDATE subject_summary SET
+        yes_responses = yes_responses {sign} ({response} IS 'y')
+        , no_responses = no_responses {sign} ({response} IS 'n')
+    WHERE subject_id = {subject_id};"""
+
+summary_sql = f"""
+DROP TABLE IF EXISTS subject_summary;
+CREATE TABLE subject_summary (
+    subject_id INTEGER PRIMARY KEY,
+    yes_responses INTEGER NOT NULL DEFAULT 0,
+    no_responses INTEGER NOT NULL DEFAULT 0
+);
+
+DROP TABLE IF EXISTS condition_summary;
+CREATE TABLE condition_summary (
+    condition_id INTEGER PRIMARY KEY,
+    subjects INTEGER NOT NULL DEFAULT 0,
+    responders INTEGER NOT NULL DEFAULT 0,
+    non_responders INTEGER NOT NULL DEFAULT 0,
+    birth_year_sum INTEGER NOT NULL DEFAULT 0,
+    birth_year_count INTEGER NOT NULL DEFAULT 0
+);
+
+CREATE TRIGGER subject_summary_insert AFTER INSERT ON subject
+BEGIN
+    INSERT OR IGNORE INTO subject_summary (subject_id) VALUES (NEW.subject_id);
+    INSERT OR IGNORE INTO condition_summary (condition_id) VALUES (0);
+    {_summary_delta('+', 'NEW.subject_id', _subject_buckets('NEW.subject_id'), 'NEW.date_of_birth')}
+END;
+
+CREATE TRIGGER subject_summary_delete AFTER DELETE ON subject
+BEGIN
+    {_summary_delta('-', 'OLD.subject_id', _subject_buckets('OLD.subject_id'), 'OLD.date_of_birth')}
+    DELETE FROM subject_summary WHERE subject_id = OLD.subject_id;
+END;
+
+CREATE TRIGGER subject_summary_birth AFTER UPDATE OF date_of_birth ON subject
+BEGIN
+    UPDATE condition_summary SET
+        birth_year_sum = birth_year_sum - {_birth_year('OLD.date_of_birth')} + {_birth_year('NEW.date_of_birth')}
+        , birth_year_count = birth_year_count - (OLD.date_of_birth IS NOT NULL) + (NEW.date_of_birth IS NOT NULL)
+    WHERE {_subject_buckets('NEW.subject_id')};
+END;
+
+CREATE TRIGGER subject_condition_summary_insert AFTER INSERT ON subject_condition
+WHEN EXISTS (SELECT 1 FROM subject_summary WHERE subject_id = NEW.subject_id)
+BEGIN
+    INSERT OR IGNORE INTO condition_summary (condition_id) VALUES (NEW.condition_id);
+    {_summary_delta('-', 'NEW.subject_id', "condition_id = 0 AND (SELECT count(*) FROM subject_condition WHERE subject_id = NEW.subject_id) = 1")}
+    {_summary_delta('+', 'NEW.subject_id', 'condition_id = NEW.condition_id')}
+END;
+
+CREATE TRIGGER subject_condition_summary_delete AFTER DELETE ON subject_condition
+WHEN EXISTS (SELECT 1 FROM subject_summary WHERE subject_id = OLD.subject_id)
+BEGIN
+    {_summary_delta('-', 'OLD.subject_id', 'condition_id = OLD.condition_id')}
+    INSERT OR IGNORE INTO condition_summary (condition_id) VALUES (0);
+    {_summary_delta('+', 'OLD.subject_id', "condition_id = 0 AND NOT EXISTS (SELECT 1 FROM subject_condition WHERE subject_id = OLD.subject_id)")}
+END;
 
-q4_query = """
+CREATE TRIGGER subject_treatment_summary_insert AFTER INSERT ON subject_treatment
+WHEN EXISTS (SELECT 1 FROM subject_summary WHERE subject_id = NEW.subject_id)
+BEGIN
+    {_response_delta('+', 'NEW.subject_id', 'NEW.response', 0)}
+    {_response_count('+', 'NEW.subject_id', 'NEW.response')}
+END;
+
+CREATE TRIGGER subject_treatment_summary_delete AFTER DELETE ON subject_treatment
+WHEN EXISTS (SELECT 1 FROM subject_summary WHERE subject_id = OLD.subject_id)
+BEGIN
+    {_response_count('-', 'OLD.subject_id', 'OLD.response')}
+    {_response_delta('-', 'OLD.subject_id', 'OLD.response', 0)}
+END;
+
+CREATE TRIGGER subject_treatment_summary_response AFTER UPDATE OF response ON subject_treatment
+WHEN EXISTS (SELECT 1 FROM subject_summary WHERE subject_id = NEW.subject_id)
+BEGIN
+    {_response_count('-', 'OLD.subject_id', 'OLD.response')}
+    {_response_delta('-', 'OLD.subject_id', 'OLD.response', 0)}
+    {_response_delta('+', 'NEW.subject_id', 'NEW.response', 0)}
+    {_response_count('+', 'NEW.subject_id', 'NEW.response')}
+END;
+"""
+
+# one row per sample x condition x treatment with every attribute the cohort questions
+# filter or group on. Built as a table (rebuilt on each ingest) or as a plain view;
+# cohort_query.cohort_sql reads it when given table=COHORT_TABLE.
+COHORT_TABLE = 'cohort'
+cohort_select_sql = """
 select sa.sample_id
+    , sa.sample_name
     , su.subject_id
+    , su.subject_name
+    , su.sex
+    , p.project_name
     , sa.sample_type
+    , sa.time_from_treatment_start
     , c.condition_name
     , t.treatment_name
-    , sa.time_from_treatment_start
-    , ct.cell_type_name
-    , cc.cell_count
+    , st.response
 from sample sa
-left join subject su
+join subject su
     on sa.subject_id = su.subject_id
+left join project p
+    on su.project_id = p.project_id
 left join subject_condition sc
     on su.subject_id = sc.subject_id
 left join condition c
@@ -215,93 +282,499 @@ left join subject_treatment st
     on st.subject_id = su.subject_id
 left join treatment t
     on st.treatment_id = t.treatment_id
-left join cell_count cc
-    on cc.sample_id = sa.sample_id
-left join cell_type ct
-    on cc.cell_type_id = ct.cell_type_id
-where sa.sample_type = 'PBMC'
-    and c.condition_name = 'melanoma'
-    and t.treatment_name = 'tr1'
-    and sa.time_from_treatment_start = 0
 """
 
-q5a_query = """
-select p.project_name
-    , count(distinct sa.sample_id) num_sample
-    , count(distinct su.subject_id) num_subject
-from sample sa
-left join subject su
-    on sa.subject_id = su.subject_id
-left join subject_condition sc
-    on su.subject_id = sc.subject_id
-left join condition c
-    on sc.condition_id = c.condition_id
-left join subject_treatment st
-    on st.subject_id = su.subject_id
-left join treatment t
-    on st.treatment_id = t.treatment_id
-left join cell_count cc
-    on cc.sample_id = sa.sample_id
-left join cell_type ct
-    on cc.cell_type_id = ct.cell_type_id
-left join project p
-    on su.project_id = p.project_id
-where sa.sample_type = 'PBMC'
-    and c.condition_name = 'melanoma'
-    and t.treatment_name = 'tr1'
-    and sa.time_from_treatment_start = 0
-group by p.project_name
+cohort_index_sql = """
+CREATE INDEX cohort_filter_idx
+ON cohort (sample_type, condition_name, treatment_name, time_from_treatment_start);
 """
 
-q5b_query = """
-select st.response
-    , count(distinct sa.sample_id) num_sample
-    , count(distinct su.subject_id) num_subject
-from sample sa
-left join subject su
-    on sa.subject_id = su.subject_id
-left join subject_condition sc
-    on su.subject_id = sc.subject_id
-left join condition c
-    on sc.condition_id = c.condition_id
-left join subject_treatment st
-    on st.subject_id = su.subject_id
-left join treatment t
-    on st.treatment_id = t.treatment_id
-left join cell_count cc
-    on cc.sample_id = sa.sample_id
-left join cell_type ct
-    on cc.cell_type_id = ct.cell_type_id
-left join project p
-    on su.project_id = p.project_id
-where sa.sample_type = 'PBMC'
-    and c.condition_name = 'melanoma'
-    and t.treatment_name = 'tr1'
-    and sa.time_from_treatment_start = 0
-group by st.response
+meta_sql = """
+CREATE TABLE IF NOT EXISTS ingest_meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
 """
 
-q5c_query = """
-select su.sex
-    , count(distinct sa.sample_id) num_sample
-    , count(distinct su.subject_id) num_subject
-from sample sa
-left join subject su
-    on sa.subject_id = su.subject_id
-left join subject_condition sc
-    on su.subject_id = sc.subject_id
-left join condition c
-    on sc.condition_id = c.condition_id
-left join subject_treatment st
-    on st.subject_id = su.subject_id
-left join treatment t
-    on st.treatment_id = t.treatment_id
-where sa.sample_type = 'PBMC'
-    and c.condition_name = 'melanoma'
-    and t.treatment_name = 'tr1'
-    and sa.time_from_treatment_start = 0
-group by su.sex
+staging_sql = """
+CREATE TEMP TABLE IF NOT EXISTS stage_sample (
+    sample_name TEXT PRIMARY KEY,
+    subject_id INTEGER NOT NULL,
+    sample_type TEXT,
+    time_from_treatment_start INTEGER
+);
+
+CREATE TEMP TABLE IF NOT EXISTS loaded_sample (
+    sample_name TEXT PRIMARY KEY
+);
+
+CREATE TEMP TABLE IF NOT EXISTS loaded_subject_condition (
+    subject_id INTEGER,
+    condition_id INTEGER,
+    PRIMARY KEY (subject_id, condition_id)
+);
+
+CREATE TEMP TABLE IF NOT EXISTS loaded_subject_treatment (
+    subject_id INTEGER,
+    treatment_id INTEGER,
+    PRIMARY KEY (subject_id, treatment_id)
+);
 """
+
+upsert_subject_sql = """
+INSERT INTO subject (subject_id, subject_name, project_id, sex, date_of_birth)
+VALUES (?, ?, ?, ?, ?)
+ON CONFLICT (subject_id) DO UPDATE SET
+    project_id = excluded.project_id
+    , sex = excluded.sex
+    , date_of_birth = excluded.date_of_birth
+WHERE subject.project_id IS NOT excluded.project_id
+    or subject.sex IS NOT excluded.sex
+    or subject.date_of_birth IS NOT excluded.date_of_birth
+"""
+
+upsert_subject_treatment_sql = """
+INSERT INTO subject_treatment (subject_id, treatment_id, response)
+VALUES (?, ?, ?)
+ON CONFLICT (subject_id, treatment_id) DO UPDATE SET
+    response = excluded.response
+WHERE subject_treatment.response IS NOT excluded.response
+"""
+
+upsert_sample_sql = """
+INSERT INTO sample (sample_name, subject_id, sample_type, time_from_treatment_start)
+SELECT sample_name, subject_id, sample_type, time_from_treatment_start
+from stage_sample
+where true
+ON CONFLICT (sample_name) DO UPDATE SET
+    subject_id = excluded.subject_id
+    , sample_type = excluded.sample_type
+    , time_from_treatment_start = excluded.time_from_treatment_start
+WHERE sample.subject_id IS NOT excluded.subject_id
+    or sample.sample_type IS NOT excluded.sample_type
+    or sample.time_from_treatment_start IS NOT excluded.time_from_treatment_start
+"""
+
+# ids of the staged samples once upserted, so counts are written by id rather than by name
+sample_ids_sql = """
+SELECT ss.sample_name, sa.sample_id
+from stage_sample ss
+join sample sa
+    on sa.sample_name = ss.sample_name
+"""
+
+upsert_cell_count_sql = """
+INSERT INTO cell_count (sample_id, cell_type_id, cell_count)
+VALUES (?, ?, ?)
+ON CONFLICT (sample_id, cell_type_id) DO UPDATE SET
+    cell_count = excluded.cell_count
+WHERE cell_count.cell_count IS NOT excluded.cell_count
+"""
+
+# rows that disappeared from the file are removed, children before parents
+delete_stale_sql = [
+    """
+    DELETE FROM cell_count
+    WHERE sample_id in (
+        select sample_id from sample
+        where sample_name not in (select sample_name from loaded_sample)
+    )"""
+    , """
+    DELETE FROM sample
+    WHERE sample_name not in (select sample_name from loaded_sample)"""
+    , """
+    DELETE FROM subject_condition
+    WHERE (subject_id, condition_id) not in (select subject_id, condition_id from loaded_subject_condition)"""
+    , """
+    DELETE FROM subject_treatment
+    WHERE (subject_id, treatment_id) not in (select subject_id, treatment_id from loaded_subject_treatment)"""
+    , """
+    DELETE FROM subject
+    WHERE subject_id not in (select subject_id from sample)"""
+]
+
+def population_columns(columns):
+    return [c for c in columns if c not in META_COLUMNS]
+
+def file_sha256(path, block_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def source_hash(path):
+    """Content hash of a csv file, or of every csv in a directory."""
+    if os.path.isdir(path):
+        from directory_ingest import directory_sha256
+        return directory_sha256(path)
+    return file_sha256(path)
+
+def get_meta(sqlite_conn, key, default=None):
+    row = sqlite_conn.execute("SELECT value FROM ingest_meta WHERE key = ?", (key,)).fetchone()
+    return default if row is None else row[0]
+
+def _set_meta(sqlite_conn, **values):
+    sqlite_conn.executemany("""
+    INSERT INTO ingest_meta (key, value) VALUES (?, ?)
+    ON CONFLICT (key) DO UPDATE SET value = excluded.value""", [(k, str(v)) for k, v in values.items()])
+
+def data_version(db_path=DB_PATH):
+    published_file = os.path.realpath(db_path)
+    if _published_files.setdefault(db_path, published_file) != published_file:
+        # swapped since the version was read: reconnect and read the new file's version
+        _published_files[db_path] = published_file
+        get_pool(db_path).refresh()
+        _data_versions.pop(db_path, None)
+    version = _data_versions.get(db_path)
+    if version is None:
+        try:
+            with get_pool(db_path).reader() as sqlite_conn:
+                version = int(get_meta(sqlite_conn, 'data_version', 0))
+        except sqlite3.OperationalError:
+            version = 0
+        _data_versions[db_path] = version
+    return version
+
+def _ensure_schema(sqlite_conn):
+    sqlite_conn.executescript(meta_sql)
+    if get_meta(sqlite_conn, 'schema_version') != str(SCHEMA_VERSION):
+        # schema changed (or first run): rebuild tables and force a full reload
+        sqlite_conn.executescript(schema_sql + summary_sql)
+        with sqlite_conn:
+            sqlite_conn.execute("DELETE FROM ingest_meta WHERE key = 'source_sha256'")
+            _set_meta(sqlite_conn, schema_version=SCHEMA_VERSION)
+
+def _cohort_type(sqlite_conn):
+    row = sqlite_conn.execute("SELECT type FROM sqlite_master WHERE name = ?", (COHORT_TABLE,)).fetchone()
+    return row and row[0]
+
+def _build_cohort(sqlite_conn, materialize):
+    existing = _cohort_type(sqlite_conn)
+    with sqlite_conn:
+        if existing:
+            sqlite_conn.execute(f"DROP {existing.upper()} {COHORT_TABLE}")
+        if materialize:
+            sqlite_conn.execute(f"CREATE TABLE {COHORT_TABLE} AS " + cohort_select_sql)
+            sqlite_conn.execute(cohort_index_sql)
+        else:
+            sqlite_conn.execute(f"CREATE VIEW {COHORT_TABLE} AS " + cohort_select_sql)
+    sqlite_conn.execute("ANALYZE")
+
+def init_db(csv_path, db_path=DB_PATH, chunksize=CHUNK_SIZE, force=False, materialize_cohort=True, progress=None
+            , workers=None):
+    """Bring the database in line with csv_path.
+
+    Nothing is written when the file's content hash matches the last load.
+    Otherwise samples are upserted chunk by chunk, samples missing from the
+    file are removed, the cohort table is rebuilt and the data version is
+    bumped. progress, if given, is called after every chunk with the rows
+    loaded so far and the fraction of the file read. Returns load statistics,
+    or None when the database was already up to date.
+
+    csv_path may also be a directory of csv files, parsed in parallel by
+    workers processes (see directory_ingest.py).
+    """
+    # the pool has a single writer connection, so only one ingestion runs at a time
+    with get_pool(db_path).writer() as sqlite_conn:
+        _ensure_schema(sqlite_conn)
+        source_sha256 = source_hash(csv_path)
+        cohort_current = _cohort_type(sqlite_conn) == ('table' if materialize_cohort else 'view')
+        if not force and get_meta(sqlite_conn, 'source_sha256') == source_sha256:
+            if not cohort_current:
+                _build_cohort(sqlite_conn, materialize_cohort)
+            _data_versions[db_path] = int(get_meta(sqlite_conn, 'data_version', 0))
+            return None
+        if os.path.isdir(csv_path):
+            from directory_ingest import load_directory
+            stats = load_directory(sqlite_conn, csv_path, workers, progress)
+        else:
+            stats = _load(sqlite_conn, csv_path, chunksize, progress)
+        _build_cohort(sqlite_conn, materialize_cohort)
+        with sqlite_conn:
+            data_version = int(get_meta(sqlite_conn, 'data_version', 0)) + 1
+            _set_meta(sqlite_conn, source_sha256=source_sha256, data_version=data_version)
+            if stats.get('failed'):
+                # files that failed are retried by the next load
+                sqlite_conn.execute("DELETE FROM ingest_meta WHERE key = 'source_sha256'")
+        _data_versions[db_path] = data_version
+        stats['data_version'] = data_version
+        return stats
+
+class KeyMap:
+    """In-memory name -> surrogate key map for one dimension table.
+
+    Built with a single scan when a load starts; names first seen during the
+    load get the next free keys, so resolving a chunk never goes back to SQLite.
+    """
+
+    def __init__(self, sqlite_conn, table, key_column, name_column):
+        self.table = table
+        self.key_column = key_column
+        self.name_column = name_column
+        self.keys = dict(sqlite_conn.execute(f"SELECT {name_column}, {key_column} FROM {table}"))
+        self.next_key = max(self.keys.values(), default=0) + 1
+
+    def resolve(self, names):
+        """Return (keys aligned with names, [(key, name), ...] newly assigned)."""
+        codes, uniques = pd.factorize(names)
+        new_rows = []
+        for name in uniques:
+            if name not in self.keys:
+                self.keys[name] = self.next_key
+                new_rows.append((self.next_key, name))
+                self.next_key += 1
+        unique_keys = np.fromiter((self.keys[name] for name in uniques), dtype=np.int64, count=len(uniques))
+        return unique_keys[codes], new_rows
+
+    def insert(self, sqlite_cursor, names):
+        """Resolve names, inserting any new ones as bare dimension rows."""
+        keys, new_rows = self.resolve(names)
+        if new_rows:
+            sqlite_cursor.executemany(
+                f"INSERT INTO {self.table} ({self.key_column}, {self.name_column}) VALUES (?, ?)", new_rows)
+        return keys
+
+def is_current(sqlite_conn, source_sha256):
+    """Whether the database was built by this schema version from a file with this content hash.
+
+    A database without the cohort table or view isn't current either, so a
+    load builds it there.
+    """
+    try:
+        return (get_meta(sqlite_conn, 'schema_version') == str(SCHEMA_VERSION)
+                and get_meta(sqlite_conn, 'source_sha256') == source_sha256
+                and _cohort_type(sqlite_conn) is not None)
+    except sqlite3.OperationalError:
+        # no ingest_meta table yet
+        return False
+
+def _load(sqlite_conn, csv_path, chunksize, progress=None):
+    total_bytes = os.path.getsize(csv_path)
+
+    def batches():
+        with open(csv_path, 'rb') as csv_file:
+            for chunk in pd.read_csv(csv_file, chunksize=chunksize):
+                # the parser reads ahead in blocks, so this slightly overstates the fraction done
+                yield prepare_batch(chunk), csv_file.tell() / total_bytes if total_bytes else 1.0
+
+    stats = write_batches(sqlite_conn, batches(), chunksize, progress)
+    delete_stale(sqlite_conn)
+    return stats
+
+def write_batches(sqlite_conn, batches, transaction_rows=CHUNK_SIZE, progress=None):
+    """Write (batch, fraction of the source read) pairs from prepare_batch, in order.
+
+    Commits whenever transaction_rows rows have been written since the last
+    commit, which keeps the journal and memory bounded. progress, if given,
+    is called after every batch with the rows written so far and the fraction.
+    Samples are recorded in loaded_sample for delete_stale.
+    """
+    sqlite_cursor = sqlite_conn.cursor()
+    sqlite_cursor.executescript(staging_sql)
+    for table in ['loaded_sample', 'loaded_subject_condition', 'loaded_subject_treatment']:
+        sqlite_cursor.execute(f"DELETE FROM {table}")
+
+    key_maps = {
+        'project': KeyMap(sqlite_conn, 'project', 'project_id', 'project_name')
+        , 'subject': KeyMap(sqlite_conn, 'subject', 'subject_id', 'subject_name')
+        , 'condition': KeyMap(sqlite_conn, 'condition', 'condition_id', 'condition_name')
+        , 'treatment': KeyMap(sqlite_conn, 'treatment', 'treatment_id', 'treatment_name')
+        , 'cell_type': KeyMap(sqlite_conn, 'cell_type', 'cell_type_id', 'cell_type_name')
+    }
+
+    rows = 0
+    uncommitted = 0
+    start = time.perf_counter()
+    try:
+        for batch, fraction in batches:
+            _write_batch(sqlite_cursor, batch, key_maps)
+            rows += batch['rows']
+            uncommitted += batch['rows']
+            if uncommitted >= transaction_rows:
+                sqlite_conn.commit()
+                uncommitted = 0
+            if progress:
+                progress(rows, fraction)
+        sqlite_conn.commit()
+    except BaseException:
+        sqlite_conn.rollback()
+        raise
+
+    elapsed = time.perf_counter() - start
+    return {
+        'rows': rows
+        , 'seconds': elapsed
+        , 'rows_per_sec': rows / elapsed if elapsed else float('inf')
+    }
+
+def delete_stale(sqlite_conn):
+    """Remove rows of samples, conditions and treatments the last write_batches didn't see."""
+    with sqlite_conn:
+        for sql in delete_stale_sql:
+            sqlite_conn.execute(sql)
+
+def _nullable(values):
+    # NaN/NA -> None so sqlite stores NULL
+    return np.where(pd.notna(values), values.astype(object), None).tolist()
+
+def _check(bad, column, problem):
+    # read_csv numbers rows from 0 across chunks; line 1 of the file is the header
+    if bad.any():
+        lines = (np.flatnonzero(bad.to_numpy()) + bad.index[0] + 2)[:5]
+        raise ValueError(f"{column} {problem} on line {', '.join(map(str, lines))}"
+                         + (f' ({int(bad.sum())} rows)' if bad.sum() > len(lines) else ''))
+
+def _integers(values, column):
+    numbers = pd.to_numeric(values, errors='coerce')
+    _check(values.notna() & (numbers.isna() | (numbers % 1 != 0)), column, 'is not a whole number')
+    return numbers.astype('Int64')
+
+def prepare_batch(chunk):
+    """Validate a parsed chunk of the csv and reduce it to what _write_batch inserts.
+
+    Needs no database, so it can run in a worker process (see directory_ingest.py).
+    Names of projects, subjects, conditions and treatments appear once each and
+    rows refer to them by per-batch codes, which _write_batch maps to surrogate
+    keys. Raises ValueError naming the column and lines of values the schema's
+    constraints would reject.
+    """
+    missing = [c for c in META_COLUMNS if c not in chunk.columns]
+    if missing:
+        raise ValueError(f"missing column(s) {', '.join(missing)}")
+    for column in ['project', 'subject', 'sample']:
+        _check(chunk[column].isna(), column, 'is empty')
+    _check(chunk['sex'].notna() & ~chunk['sex'].isin(SEX_VALUES), 'sex', f'is not one of {SEX_VALUES}')
+    _check(chunk['response'].notna() & ~chunk['response'].isin(RESPONSE_VALUES), 'response'
+           , f'is not one of {RESPONSE_VALUES}')
+    _check(chunk['sample'].duplicated(), 'sample', 'repeats an earlier sample')
+    ages = _integers(chunk['age'], 'age')
+    timepoints = _integers(chunk['time_from_treatment_start'], 'time_from_treatment_start')
+    populations = population_columns(chunk.columns)
+    counts = chunk[populations].apply(pd.to_numeric, errors='coerce')
+    _check((counts.isna() | (counts < 0) | (counts % 1 != 0)).any(axis=1), 'cell counts'
+           , 'are not all non-negative whole numbers')
+
+    project_codes, projects = pd.factorize(chunk['project'])
+    subject_codes, subjects = pd.factorize(chunk['subject'])
+    # subjects repeat once per sample; keep one row each (last wins, like the upserts)
+    last = pd.Series(np.arange(len(chunk))).groupby(subject_codes).last().to_numpy()
+    reference_year, reference_month_day = AGE_REFERENCE_DATE.split('-', 1)
+    birth_year = (int(reference_year) - ages.iloc[last]).reset_index(drop=True)
+    date_of_birth = (birth_year.astype(str) + '-' + reference_month_day).where(birth_year.notna())
+
+    has_condition = (chunk['condition'].notna() & (chunk['condition'] != NO_CONDITION)).to_numpy()
+    condition_codes, conditions = pd.factorize(chunk['condition'][has_condition])
+    subject_conditions = np.unique(np.column_stack([subject_codes[has_condition], condition_codes]), axis=0)
+
+    has_treatment = (chunk['treatment'].notna() & (chunk['treatment'] != NO_TREATMENT)).to_numpy()
+    treatment_codes, treatments = pd.factorize(chunk['treatment'][has_treatment])
+    subject_treatments = pd.DataFrame({
+        'subject': subject_codes[has_treatment]
+        , 'treatment': treatment_codes
+        , 'response': chunk['response'][has_treatment].to_numpy()
+    }).drop_duplicates(['subject', 'treatment'], keep='last')
+
+    return {
+        'rows': len(chunk)
+        , 'projects': projects.tolist()
+        , 'subjects': subjects.tolist()
+        , 'subject_project': project_codes[last].astype(np.int32)
+        , 'subject_sex': _nullable(chunk['sex'].to_numpy()[last])
+        , 'subject_date_of_birth': _nullable(date_of_birth)
+        , 'conditions': conditions.tolist()
+        , 'subject_conditions': subject_conditions.astype(np.int32)
+        , 'treatments': treatments.tolist()
+        , 'subject_treatments': subject_treatments[['subject', 'treatment']].to_numpy(dtype=np.int32)
+        , 'treatment_responses': _nullable(subject_treatments['response'])
+        , 'samples': chunk['sample'].astype(str).tolist()
+        , 'sample_subject': subject_codes.astype(np.int32)
+        , 'sample_types': _nullable(chunk['sample_type'])
+        , 'timepoints': _nullable(timepoints)
+        , 'populations': populations
+        , 'counts': counts.to_numpy(dtype=np.int64)
+    }
+
+def _write_batch(sqlite_cursor, batch, key_maps):
+    cell_type_ids = key_maps['cell_type'].insert(sqlite_cursor, pd.Series(batch['populations']))
+    project_ids = key_maps['project'].insert(sqlite_cursor, pd.Series(batch['projects'], dtype=object))
+    subject_ids, _ = key_maps['subject'].resolve(pd.Series(batch['subjects'], dtype=object))
+    sqlite_cursor.executemany(upsert_subject_sql, zip(
+        subject_ids.tolist()
+        , batch['subjects']
+        , project_ids[batch['subject_project']].tolist()
+        , batch['subject_sex']
+        , batch['subject_date_of_birth']
+    ))
+
+    if len(batch['subject_conditions']):
+        condition_ids = key_maps['condition'].insert(sqlite_cursor, pd.Series(batch['conditions'], dtype=object))
+        condition_rows = list(zip(subject_ids[batch['subject_conditions'][:, 0]].tolist()
+                                  , condition_ids[batch['subject_conditions'][:, 1]].tolist()))
+        sqlite_cursor.executemany("""
+        INSERT INTO subject_condition (subject_id, condition_id) VALUES (?, ?)
+        ON CONFLICT DO NOTHING""", condition_rows)
+        sqlite_cursor.executemany("""
+        INSERT OR IGNORE INTO loaded_subject_condition VALUES (?, ?)""", condition_rows)
+
+    if len(batch['subject_treatments']):
+        treatment_ids = key_maps['treatment'].insert(sqlite_cursor, pd.Series(batch['treatments'], dtype=object))
+        treatment_subject_ids = subject_ids[batch['subject_treatments'][:, 0]].tolist()
+        treatment_ids = treatment_ids[batch['subject_treatments'][:, 1]].tolist()
+        sqlite_cursor.executemany(upsert_subject_treatment_sql, zip(
+            treatment_subject_ids, treatment_ids, batch['treatment_responses']))
+        sqlite_cursor.executemany("""
+        INSERT OR IGNORE INTO loaded_subject_treatment VALUES (?, ?)""", zip(treatment_subject_ids, treatment_ids))
+
+    # samples can number in the millions, so they are keyed through the sample_name
+    # index inside sqlite rather than an in-memory map
+    sample_names = batch['samples']
+    sqlite_cursor.execute("DELETE FROM stage_sample")
+    sqlite_cursor.executemany("""
+    INSERT INTO stage_sample (sample_name, subject_id, sample_type, time_from_treatment_start)
+    VALUES (?, ?, ?, ?)""", zip(
+        sample_names
+        , subject_ids[batch['sample_subject']].tolist()
+        , batch['sample_types']
+        , batch['timepoints']
+    ))
+
+    sqlite_cursor.execute(upsert_sample_sql)
+    sample_ids = dict(sqlite_cursor.execute(sample_ids_sql))
+    sample_ids = np.fromiter((sample_ids[name] for name in sample_names), dtype=np.int64, count=len(sample_names))
+
+    # long layout: every sample repeated once per population, counts read row-major
+    sqlite_cursor.executemany(upsert_cell_count_sql, zip(
+        np.repeat(sample_ids, len(cell_type_ids)).tolist()
+        , np.tile(cell_type_ids, len(sample_names)).tolist()
+        , batch['counts'].ravel().tolist()
+    ))
+    sqlite_cursor.execute("INSERT OR IGNORE INTO loaded_sample SELECT sample_name FROM stage_sample")
+
+# condition_summary is maintained by triggers, so this reads one row per condition.
+# Age is the difference in calendar years, averaged over subjects.
+q3_query = """
+select
+    c.condition_name
+    , cs.subjects as unique_patients
+    , cs.responders
+    , cs.non_responders
+    , round(strftime('%Y', 'now') - cast(cs.birth_year_sum as real) / cs.birth_year_count, 2) average_age
+from condition_summary cs
+left join condition c
+    on c.condition_id = cs.condition_id
+where cs.subjects > 0
+order by c.condition_name"""
+
+# Questions 4 and 5: melanoma PBMC samples at baseline from subjects treated with tr1
+BASELINE_COHORT = {'sample_type': 'PBMC', 'condition': 'melanoma', 'treatment': 'tr1', 'time_from_treatment_start': (0, 0)}
+
+q4_query, q4_params = cohort_sql(BASELINE_COHORT, cell_counts=True, table=COHORT_TABLE)
+# the cohort pins one condition and one treatment, so each sample is counted once
+q5a_query, q5a_params = cohort_sql(BASELINE_COHORT, group_by=['project'], table=COHORT_TABLE)
+q5b_query, q5b_params = cohort_sql(BASELINE_COHORT, group_by=['response'], table=COHORT_TABLE)
+q5c_query, q5c_params = cohort_sql(BASELINE_COHORT, group_by=['sex'], table=COHORT_TABLE)
+
 # sqlite_conn = sqlite3.connect("demo_db.sqlite")
 # sqlite_cursor = sqlite_conn.cursor()
 # if 'sqlite_init' not in st.session_state:
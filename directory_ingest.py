@@ -0,0 +1,148 @@
+"""Load a directory of cell-count csv files (e.g. one per project per batch) into one database.
+
+    python directory_ingest.py data/batches/
+    python directory_ingest.py data/batches/ --db batches_db.sqlite --workers 8
+
+database.init_db uses this when its source is a directory. Files are parsed
+and validated in parallel by a process pool, each into a compact batch
+(database.prepare_batch): every project, subject, condition and treatment
+name once, typed sample and count arrays, and per-file codes tying them
+together. This process is the only writer. It takes finished batches in file
+order from a bounded window of files in flight, resolves their codes to
+surrogate keys and writes them in transactions of TRANSACTION_ROWS rows, so
+at most a couple of files per worker wait in memory. A file that can't be
+parsed or validated is reported and skipped; the others still load.
+
+The command line loads into a new generation of --db and publishes it with
+ingest.py's symlink swap, like the app's own loads. It won't write the app's
+database (DB_PATH): the app reloads that from its csv, which would delete
+the directory's rows again.
+"""
+import argparse
+import glob
+import hashlib
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+from multiprocessing import get_context
+import pandas as pd
+from database import DB_PATH, delete_stale, file_sha256, prepare_batch, write_batches
+
+FILE_PATTERN = '*.csv'
+DIRECTORY_DB_PATH = 'batches_db.sqlite'
+# rows written per transaction; larger than one file so small files share a commit
+TRANSACTION_ROWS = 200_000
+# files parsed ahead of the writer per worker, which bounds the batches held in memory
+PENDING_PER_WORKER = 2
+
+def csv_files(dir_path, pattern=FILE_PATTERN):
+    return sorted(glob.glob(os.path.join(glob.escape(dir_path), pattern)))
+
+def directory_sha256(dir_path, pattern=FILE_PATTERN):
+    # covers every file's name and content, so adding, removing or editing one changes it
+    digest = hashlib.sha256()
+    for path in csv_files(dir_path, pattern):
+        digest.update(f'{os.path.basename(path)}\0{file_sha256(path)}\n'.encode())
+    return digest.hexdigest()
+
+def parse_file(path):
+    """Read and validate one csv into a batch; runs in a worker process."""
+    return prepare_batch(pd.read_csv(path))
+
+def _parsed(paths, workers, failures):
+    # yields (path, batch or None) in file order; failures collects {'path', 'error'}
+    def failed(path, e):
+        failures.append({'path': path, 'error': f'{type(e).__name__}: {e}'})
+        return path, None
+
+    if workers == 1:
+        for path in paths:
+            try:
+                batch = parse_file(path)
+            except Exception as e:
+                yield failed(path, e)
+            else:
+                yield path, batch
+        return
+
+    # spawned workers, since ingestion can run on a thread of the (multi-threaded) app
+    with ProcessPoolExecutor(workers, mp_context=get_context('spawn')) as executor:
+        remaining = iter(paths)
+        pending = deque((path, executor.submit(parse_file, path))
+                        for path in islice(remaining, workers * PENDING_PER_WORKER))
+        try:
+            while pending:
+                path, future = pending.popleft()
+                # refill the window before writing, so workers parse while this process writes
+                for next_path in islice(remaining, 1):
+                    pending.append((next_path, executor.submit(parse_file, next_path)))
+                try:
+                    batch = future.result()
+                except Exception as e:
+                    yield failed(path, e)
+                else:
+                    yield path, batch
+        finally:
+            # the writer stopped early: don't parse files nobody will write
+            for _, future in pending:
+                future.cancel()
+
+def load_directory(sqlite_conn, dir_path, workers=None, progress=None, pattern=FILE_PATTERN
+                   , transaction_rows=TRANSACTION_ROWS):
+    """Write every csv in dir_path (in name order, later files winning) through sqlite_conn.
+
+    Rows of samples, conditions and treatments that are in none of the files
+    are deleted afterwards, unless a file failed: its rows from earlier loads
+    are kept then. Returns load statistics with 'files' and 'failed', a list
+    of {'path', 'error'}.
+    """
+    paths = csv_files(dir_path, pattern)
+    if not paths:
+        raise ValueError(f'no files matching {pattern} in {dir_path}')
+    workers = min(workers or os.cpu_count() or 1, len(paths))
+    sizes = [os.path.getsize(path) for path in paths]
+    total_bytes = sum(sizes)
+    failures = []
+
+    def batches():
+        done_bytes = 0
+        for size, (path, batch) in zip(sizes, _parsed(paths, workers, failures)):
+            done_bytes += size
+            if batch is not None:
+                yield batch, done_bytes / total_bytes if total_bytes else 1.0
+
+    stats = write_batches(sqlite_conn, batches(), transaction_rows, progress)
+    if not failures:
+        delete_stale(sqlite_conn)
+    stats.update(files=len(paths), failed=failures)
+    return stats
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Load a directory of cell-count CSVs into the SQLite database.')
+    parser.add_argument('directory', help='directory holding the csv files')
+    parser.add_argument('--db', default=DIRECTORY_DB_PATH, help=f'database file (default: {DIRECTORY_DB_PATH})')
+    parser.add_argument('--workers', type=int, default=None, help='parser processes (default: CPU count, 1 = no pool)')
+    parser.add_argument('--force', action='store_true', help='reload even if no file changed')
+    args = parser.parse_args(argv)
+    if os.path.realpath(args.db) == os.path.realpath(DB_PATH):
+        parser.error(f'{args.db} is the app\'s database, which it reloads from its own csv; choose another --db')
+
+    from ingest import start_ingest
+    job = start_ingest(args.directory, args.db, workers=args.workers, force=args.force)
+    job.wait()
+    if job.error is not None:
+        print(f'loading {args.directory} failed: {type(job.error).__name__}: {job.error}')
+        return 1
+    stats = job.stats
+    if stats is None:
+        print(f'{args.db} is up to date with {args.directory}')
+        return 0
+    print(f"{stats['rows']:,} rows from {stats['files'] - len(stats['failed'])} of {stats['files']} files "
+          f"in {stats['seconds']:.2f}s ({stats['rows_per_sec']:,.0f} rows/s), data version {stats['data_version']}")
+    for failure in stats['failed']:
+        print(f"failed: {failure['path']}: {failure['error']}")
+    return 1 if stats['failed'] else 0
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,175 @@
+"""Stream query results and the Question 1 table to CSV or Parquet files in bounded memory.
+
+    python export.py "select * from cell_count" -o cell_count.parquet
+    python export.py --question1 data/cell-count.csv -o question1.csv
+
+Rows are fetched from a SQLite cursor BATCH_ROWS at a time and each batch is
+written before the next is fetched, through pyarrow's record-batch writers
+(pyarrow.csv.CSVWriter, or pyarrow.parquet.ParquetWriter with one row group
+per batch). Memory stays bounded by one batch whatever the size of the result.
+"""
+import argparse
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+import pyarrow as pa
+import pyarrow.csv as pacsv
+import pyarrow.parquet as pq
+from database import DB_PATH, population_columns
+from guarded_query import guarded_cursor, unique_columns
+from pool import get_pool
+
+BATCH_ROWS = 50_000
+FORMATS = {'csv': 'text/csv', 'parquet': 'application/vnd.apache.parquet'}
+# ad-hoc exports may read far more rows than a result page, so they get longer than DEFAULT_TIMEOUT_S
+EXPORT_TIMEOUT_S = 300.0
+
+EXPORT_DIR = os.path.join(tempfile.gettempdir(), 'teiko-exports')
+# exported files older than this are deleted when the next export starts
+EXPORT_MAX_AGE_S = 3600
+
+class ExportError(Exception):
+    pass
+
+def _array(values, type=None):
+    try:
+        return pa.array(values, type=type)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        # sqlite columns can mix types; fall back to text
+        return pa.array([None if v is None else str(v) for v in values], type=pa.string())
+
+class BatchWriter:
+    """Appends record batches to a csv or parquet file; the first batch fixes the schema."""
+
+    def __init__(self, path, fmt):
+        if fmt not in FORMATS:
+            raise ExportError(f"format must be one of {', '.join(FORMATS)}")
+        self.path = path
+        self.fmt = fmt
+        self.schema = None
+        self.rows = 0
+        self._writer = None
+
+    def write_rows(self, columns, rows):
+        """Write a list of row tuples, e.g. from cursor.fetchmany."""
+        if rows:
+            types = [None] * len(columns) if self.schema is None else self.schema.types
+            arrays = [_array(values, type) for values, type in zip(zip(*rows), types)]
+        else:
+            arrays = [pa.array([], type=pa.string()) for _ in columns]
+        self.write_batch(pa.RecordBatch.from_arrays(arrays, names=columns))
+
+    def write_frame(self, frame):
+        self.write_batch(pa.RecordBatch.from_pandas(frame, preserve_index=False))
+
+    def write_batch(self, batch):
+        if self._writer is None:
+            fields = []
+            for field in batch.schema:
+                if pa.types.is_null(field.type):
+                    # a column that is all NULL in the first batch may hold text later
+                    field = field.with_type(pa.string())
+                elif self.fmt == 'csv' and pa.types.is_dictionary(field.type):
+                    field = field.with_type(field.type.value_type)
+                fields.append(field)
+            self.schema = pa.schema(fields)
+            if self.fmt == 'csv':
+                self._writer = pacsv.CSVWriter(self.path, self.schema)
+            else:
+                self._writer = pq.ParquetWriter(self.path, self.schema)
+        try:
+            if batch.schema != self.schema:
+                batch = batch.cast(self.schema)
+            self._writer.write_batch(batch)
+        except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError) as e:
+            raise ExportError(f'row {self.rows + 1:,} onwards does not fit the types of the first rows: {e}') from None
+        self.rows += batch.num_rows
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+
+def export_cursor(cursor, path, fmt, batch_rows=BATCH_ROWS):
+    """Write every remaining row of cursor to path; returns the number of rows."""
+    if cursor.description is None:
+        raise ExportError('the statement returns no rows to export')
+    columns = unique_columns(d[0] for d in cursor.description)
+    writer = BatchWriter(path, fmt)
+    try:
+        while True:
+            rows = cursor.fetchmany(batch_rows)
+            if not rows:
+                break
+            writer.write_rows(columns, rows)
+        if not writer.rows:
+            writer.write_rows(columns, [])
+    finally:
+        writer.close()
+    return writer.rows
+
+def export_query(sql, path, fmt, params=(), db_path=DB_PATH, batch_rows=BATCH_ROWS):
+    """Export the result of one of the app's own queries."""
+    try:
+        with get_pool(db_path).reader() as sqlite_conn:
+            return export_cursor(sqlite_conn.execute(sql, params), path, fmt, batch_rows)
+    except sqlite3.Error as e:
+        raise ExportError(str(e)) from None
+
+def export_guarded_query(sql, path, fmt, db_path=DB_PATH, timeout=EXPORT_TIMEOUT_S, batch_rows=BATCH_ROWS):
+    """Export the result of an untrusted statement, under the same guard as the ad-hoc query box."""
+    with guarded_cursor(db_path, sql, timeout) as (cursor, _):
+        return export_cursor(cursor, path, fmt, batch_rows)
+
+def export_question1(table, path, fmt, batch_rows=BATCH_ROWS):
+    """Export the Question 1 rows for a cell-count pyarrow Table (e.g. snapshot.read_snapshot)."""
+    from frequency import Q1_COLUMNS, relative_frequency
+    n_populations = max(len(population_columns(table.column_names)), 1)
+    writer = BatchWriter(path, fmt)
+    try:
+        # each sample becomes one row per population
+        for batch in table.to_batches(max_chunksize=max(batch_rows // n_populations, 1)):
+            writer.write_frame(relative_frequency(batch.to_pandas(), id_columns=[])[Q1_COLUMNS])
+    finally:
+        writer.close()
+    return writer.rows
+
+def new_export_path(fmt):
+    """A fresh file in EXPORT_DIR, pruning exports older than EXPORT_MAX_AGE_S first."""
+    os.makedirs(EXPORT_DIR, exist_ok=True)
+    cutoff = time.time() - EXPORT_MAX_AGE_S
+    for entry in os.scandir(EXPORT_DIR):
+        try:
+            if entry.stat().st_mtime < cutoff:
+                os.remove(entry.path)
+        except FileNotFoundError:
+            # another session pruned it first
+            pass
+    fd, path = tempfile.mkstemp(suffix=f'.{fmt}', dir=EXPORT_DIR)
+    os.close(fd)
+    return path
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Export a query result or the Question 1 table to CSV or Parquet.')
+    parser.add_argument('source', help='a SQL query, or with --question1 a cell-count csv')
+    parser.add_argument('-o', '--output', required=True, help='output file; .csv or .parquet picks the format')
+    parser.add_argument('--format', choices=list(FORMATS), default=None, help='override the format')
+    parser.add_argument('--question1', action='store_true', help='export the Question 1 table of the csv in source')
+    parser.add_argument('--db', default=DB_PATH, help=f'database file (default: {DB_PATH})')
+    args = parser.parse_args(argv)
+
+    fmt = args.format or os.path.splitext(args.output)[1].lstrip('.').lower()
+    start = time.perf_counter()
+    try:
+        if args.question1:
+            from snapshot import read_snapshot
+            rows = export_question1(read_snapshot(args.source), args.output, fmt)
+        else:
+            rows = export_query(args.source, args.output, fmt, db_path=args.db)
+    except ExportError as e:
+        parser.error(str(e))
+    print(f'{rows:,} rows to {args.output} in {time.perf_counter() - start:.2f}s', file=sys.stderr)
+
+if __name__ == '__main__':
+    main()
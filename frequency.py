@@ -0,0 +1,48 @@
+import numpy as np
+import pandas as pd
+from database import population_columns
+
+Q1_COLUMNS = ['sample', 'total_count', 'population', 'count', 'percentage']
+
+def percentages(counts, total_count):
+    """counts (samples x populations) as percentages of each sample's total_count; NaN where it is 0."""
+    return np.divide(counts * 100.0, total_count[:, None]
+                     , out=np.full(counts.shape, np.nan), where=total_count[:, None] != 0)
+
+def relative_frequency(cell_count_df, populations=None, id_columns=None):
+    """Long format of cell_count_df: one row per sample and population.
+
+    Returns the Question 1 columns (percentage in 0-100) followed by
+    id_columns repeated per population; id_columns defaults to every
+    non-population column so cohorts can be filtered without a merge.
+    Rows are sample-major, population is categorical, and only the count
+    matrix and the output columns are ever materialized.
+    """
+    if populations is None:
+        populations = population_columns(cell_count_df.columns)
+    if id_columns is None:
+        id_columns = [c for c in cell_count_df.columns if c not in populations and c != 'sample']
+
+    counts = cell_count_df[populations].to_numpy(dtype=np.int64)
+    n_samples, n_populations = counts.shape
+    total_count = counts.sum(axis=1)
+    percentage = percentages(counts, total_count)
+
+    long = {
+        'sample': np.repeat(cell_count_df['sample'].to_numpy(), n_populations)
+        , 'total_count': np.repeat(total_count, n_populations)
+        , 'population': pd.Categorical.from_codes(
+            np.tile(np.arange(n_populations, dtype=np.int8 if n_populations < 128 else np.int32), n_samples)
+            , categories=populations)
+        , 'count': counts.ravel()
+        , 'percentage': percentage.ravel()
+    }
+    for column in id_columns:
+        values = cell_count_df[column]
+        if pd.api.types.is_numeric_dtype(values):
+            long[column] = np.repeat(values.to_numpy(), n_populations)
+        else:
+            # repeat integer codes rather than python objects
+            codes, uniques = pd.factorize(values)
+            long[column] = pd.Categorical.from_codes(np.repeat(codes, n_populations), categories=uniques)
+    return pd.DataFrame(long)
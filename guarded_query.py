@@ -0,0 +1,120 @@
+import sqlite3
+import time
+from contextlib import contextmanager
+import pandas as pd
+from pool import PoolTimeout, get_pool
+
+DEFAULT_TIMEOUT_S = 5.0
+DEFAULT_PAGE_SIZE = 500
+# no ad-hoc query may page further than this many rows into its result
+ROW_CAP = 100_000
+FETCH_BATCH = 1000
+# the progress handler runs every this many SQLite VM instructions
+PROGRESS_STEPS = 1000
+
+# statements may only read; PRAGMA is limited to schema introspection
+_ALLOWED_ACTIONS = {sqlite3.SQLITE_SELECT, sqlite3.SQLITE_READ, sqlite3.SQLITE_FUNCTION, sqlite3.SQLITE_RECURSIVE}
+_ALLOWED_PRAGMAS = {'table_info', 'table_xinfo', 'table_list', 'index_list', 'index_info', 'index_xinfo'
+                    , 'foreign_key_list', 'database_list'}
+
+class GuardedQueryError(Exception):
+    pass
+
+class QueryTimeout(GuardedQueryError):
+    pass
+
+def _authorizer(action, arg1, arg2, db_name, trigger_name):
+    if action in _ALLOWED_ACTIONS:
+        return sqlite3.SQLITE_OK
+    if action == sqlite3.SQLITE_PRAGMA and arg1 and arg1.lower() in _ALLOWED_PRAGMAS:
+        return sqlite3.SQLITE_OK
+    return sqlite3.SQLITE_DENY
+
+@contextmanager
+def guarded_cursor(db_path, sql, timeout=DEFAULT_TIMEOUT_S):
+    """Execute one untrusted read-only statement and yield (cursor, steps).
+
+    The statement runs on a pooled read-only connection with an authorizer
+    that rejects anything but reads and is interrupted once timeout seconds
+    have passed, including time spent fetching from the cursor. steps() is
+    the number of VM steps executed so far (a proxy for rows scanned).
+    SQLite errors, raised by execute or by fetching, become GuardedQueryError.
+    """
+    steps = 0
+    deadline = time.perf_counter() + timeout
+
+    def progress():
+        nonlocal steps
+        steps += PROGRESS_STEPS
+        # a non-zero return interrupts the running statement
+        return time.perf_counter() > deadline
+
+    try:
+        with get_pool(db_path).reader() as sqlite_conn:
+            sqlite_conn.set_authorizer(_authorizer)
+            sqlite_conn.set_progress_handler(progress, PROGRESS_STEPS)
+            try:
+                cursor = sqlite_conn.execute(sql)
+                yield cursor, lambda: steps
+                cursor.close()
+            except sqlite3.OperationalError as e:
+                if 'interrupted' in str(e):
+                    raise QueryTimeout(f'query cancelled after {timeout:g}s') from None
+                raise GuardedQueryError(str(e)) from None
+            except (sqlite3.DatabaseError, sqlite3.ProgrammingError, sqlite3.Warning) as e:
+                raise GuardedQueryError(str(e)) from None
+            finally:
+                sqlite_conn.set_progress_handler(None, 0)
+                sqlite_conn.set_authorizer(None)
+    except PoolTimeout as e:
+        # every reader stayed busy, e.g. with long exports
+        raise GuardedQueryError(str(e)) from None
+
+def unique_columns(columns):
+    # joins like "select *" can repeat a column name, which the result grid can't display
+    seen = {}
+    columns = list(columns)
+    for i, column in enumerate(columns):
+        if column in seen:
+            seen[column] += 1
+            columns[i] = f'{column}_{seen[column]}'
+        else:
+            seen[column] = 0
+    return columns
+
+def run_guarded_query(db_path, sql, page=0, page_size=DEFAULT_PAGE_SIZE, timeout=DEFAULT_TIMEOUT_S, row_cap=ROW_CAP):
+    """Run one untrusted read-only statement and return (page DataFrame, report).
+
+    The statement runs through guarded_cursor and is streamed with fetchmany:
+    rows before the requested page are discarded batch by batch and at most
+    page_size + 1 rows are kept. The report carries the elapsed time, rows
+    read from the cursor, VM steps executed and whether another page exists.
+    """
+    offset = page * page_size
+    if page < 0 or page_size <= 0:
+        raise GuardedQueryError('page must be >= 0 and page_size > 0')
+    if offset + page_size > row_cap:
+        raise GuardedQueryError(f'ad-hoc queries can only be paged through the first {row_cap:,} rows')
+
+    start = time.perf_counter()
+    with guarded_cursor(db_path, sql, timeout) as (cursor, steps):
+        rows_read = 0
+        while rows_read < offset:
+            skipped = cursor.fetchmany(min(FETCH_BATCH, offset - rows_read))
+            if not skipped:
+                break
+            rows_read += len(skipped)
+        rows = cursor.fetchmany(page_size + 1)
+        rows_read += len(rows)
+        columns = [d[0] for d in cursor.description] if cursor.description else []
+
+    has_more = len(rows) > page_size
+    report = {
+        'elapsed_s': time.perf_counter() - start
+        , 'rows_read': rows_read
+        , 'vm_steps': steps()
+        , 'page': page
+        , 'page_size': page_size
+        , 'has_more': has_more
+    }
+    return pd.DataFrame(rows[:page_size], columns=unique_columns(columns)), report
@@ -0,0 +1,97 @@
+"""Cold-start cost of the Streamlit app: slowest imports and per-page time and memory.
+
+    python import_report.py
+    python import_report.py --top 15 -o import-report.json
+
+`import main` is profiled with -X importtime. Every page is then rendered
+through Streamlit's AppTest in a fresh process, so its numbers are a cold
+start of that page: seconds to render, peak RSS and which heavy libraries it
+loaded. The first data page in a process also hashes the csv for ingestion.
+"""
+import argparse
+import json
+import os
+import re
+import resource
+import subprocess
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+PAGES = ['Home', 'Python Tasks', 'Database Tasks', 'More about Leopold']
+HEAVY_MODULES = ['numpy', 'pandas', 'pyarrow', 'scipy', 'plotly.express']
+
+_IMPORTTIME_LINE = re.compile(r'import time:\s+(\d+) \|\s+(\d+) \| (\s*)(\S+)')
+
+def import_times(module='main', top=10):
+    """Total import seconds of module and its slowest direct imports, from -X importtime."""
+    stderr = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}']
+                            , cwd=APP_DIR, capture_output=True, text=True, check=True).stderr
+    total = 0
+    direct = []
+    for match in _IMPORTTIME_LINE.finditer(stderr):
+        cumulative_us, depth, name = int(match.group(2)), len(match.group(3)) // 2, match.group(4)
+        if depth == 0 and name == module:
+            total = cumulative_us / 1e6
+        elif depth == 1:
+            direct.append({'module': name, 'seconds': cumulative_us / 1e6})
+    direct.sort(key=lambda d: d['seconds'], reverse=True)
+    return total, direct[:top]
+
+def _peak_rss_mb():
+    # same measure as benchmark.py, kept local so the report doesn't import numpy itself
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+def _render_page(page):
+    # runs in a fresh process; the app always opens on Home, other pages are one click away
+    os.chdir(APP_DIR)
+    from streamlit.testing.v1 import AppTest
+    loaded = set(sys.modules)
+    start = time.perf_counter()
+    app = AppTest.from_file('main.py', default_timeout=300)
+    app.run()
+    if page != PAGES[0]:
+        app.sidebar.radio[0].set_value(page).run()
+    seconds = time.perf_counter() - start
+    if app.exception:
+        raise RuntimeError(f'{page} failed: {app.exception[0].message}')
+    return {
+        'page': page
+        , 'seconds': seconds
+        , 'peak_rss_mb': _peak_rss_mb()
+        , 'heavy_modules': [m for m in HEAVY_MODULES if m in sys.modules and m not in loaded]
+    }
+
+def page_costs(pages=PAGES):
+    results = []
+    for page in pages:
+        with ProcessPoolExecutor(1, mp_context=get_context('spawn')) as executor:
+            results.append(executor.submit(_render_page, page).result())
+    return results
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Report import time and per-page cold-start cost of the app.')
+    parser.add_argument('--top', type=int, default=10, help='slowest direct imports of main to list')
+    parser.add_argument('--pages', nargs='+', default=PAGES, choices=PAGES)
+    parser.add_argument('-o', '--output', default=None, help='also write the report as JSON')
+    args = parser.parse_args(argv)
+
+    total, slowest = import_times('main', args.top)
+    print(f'import main: {total:.3f}s')
+    for entry in slowest:
+        print(f"  {entry['module']:<30} {entry['seconds']:8.3f}s")
+
+    pages = page_costs(args.pages)
+    for page in pages:
+        print(f"{page['page']:>20}: {page['seconds']:7.2f}s {page['peak_rss_mb']:8.1f} MB  "
+              f"loads {', '.join(page['heavy_modules']) or 'nothing heavy'}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'import_main_s': total, 'slowest_imports': slowest, 'pages': pages}, f, indent=2)
+
+if __name__ == '__main__':
+    main()
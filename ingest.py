@@ -0,0 +1,170 @@
+"""Background ingestion into a new database file, published with an atomic swap.
+
+DB_PATH is a symlink to the current generation file (demo_db.<n>.sqlite).
+A load copies the current generation to generation n + 1, brings the copy in
+line with the csv there, and then replaces the symlink in one rename. Readers
+keep querying the old file throughout. Queries already running finish on it,
+and the pool reopens idle readers on the new one. SQLite resolves the link,
+so journal files are named after the generation file, never after DB_PATH.
+"""
+import glob
+import os
+import re
+import sqlite3
+import threading
+import time
+import database
+from database import DB_PATH, get_meta, init_db, is_current, source_hash
+from pool import close_pool, get_pool
+
+# generation files older than this many swaps are deleted
+KEEP_GENERATIONS = 2
+
+_jobs = {}
+_jobs_lock = threading.Lock()
+
+def _generation_path(db_path, generation):
+    base, ext = os.path.splitext(db_path)
+    return f'{base}.{generation}{ext}'
+
+def _generations(db_path):
+    base, ext = os.path.splitext(db_path)
+    pattern = re.compile(re.escape(os.path.basename(base)) + r'\.(\d+)' + re.escape(ext) + '$')
+    found = {}
+    for path in glob.glob(f'{glob.escape(base)}.*{ext}'):
+        match = pattern.match(os.path.basename(path))
+        if match:
+            found[int(match.group(1))] = path
+    return found
+
+def publish(staging_path, db_path):
+    """Atomically point db_path at staging_path (same directory) and reconnect readers."""
+    link_path = db_path + '.link'
+    if os.path.lexists(link_path):
+        os.remove(link_path)
+    os.symlink(os.path.basename(staging_path), link_path)
+    os.replace(link_path, db_path)
+    get_pool(db_path).refresh()
+
+def _remove_files(path):
+    for suffix in ('', '-wal', '-shm', '-journal'):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+
+def _remove_old_generations(db_path, current):
+    for generation, path in _generations(db_path).items():
+        if generation <= current - KEEP_GENERATIONS:
+            _remove_files(path)
+
+class IngestJob:
+    """One background load of csv_path (a csv or a directory); status() is safe to call from any thread."""
+
+    def __init__(self, csv_path, db_path=DB_PATH, after_load=None, workers=None, force=False):
+        self.csv_path = csv_path
+        self.db_path = db_path
+        # passed on to init_db; force also skips the up-to-date check against the published file
+        self.workers = workers
+        self.force = force
+        # called with the csv path once the new database is built, before it is published
+        self.after_load = after_load
+        self.phase = 'starting'
+        self.rows = 0
+        self.fraction = 0.0
+        self.started = time.time()
+        self.finished = None
+        self.stats = None
+        self.error = None
+        self.data_version = None
+        self._thread = threading.Thread(target=self._run, name=f'ingest {csv_path}', daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    @property
+    def running(self):
+        return self._thread.is_alive()
+
+    def wait(self, timeout=None):
+        self._thread.join(timeout)
+        return not self.running
+
+    def status(self):
+        elapsed = (self.finished or time.time()) - self.started
+        eta = None
+        if self.phase == 'loading' and 0 < self.fraction < 1:
+            eta = elapsed * (1 - self.fraction) / self.fraction
+        return {
+            'phase': self.phase
+            , 'rows': self.rows
+            , 'fraction': self.fraction
+            , 'elapsed_s': elapsed
+            , 'eta_s': eta
+            , 'data_version': self.data_version
+            , 'error': None if self.error is None else str(self.error)
+        }
+
+    def _progress(self, rows, fraction):
+        self.rows = rows
+        self.fraction = min(fraction, 1.0)
+
+    def _run(self):
+        try:
+            self._ingest()
+        except Exception as e:
+            self.error = e
+            self.phase = 'failed'
+        finally:
+            self.finished = time.time()
+
+    def _ingest(self):
+        self.phase = 'checking'
+        source_sha256 = source_hash(self.csv_path)
+        published = os.path.exists(self.db_path)
+        if published and not self.force:
+            with get_pool(self.db_path).reader() as sqlite_conn:
+                if is_current(sqlite_conn, source_sha256):
+                    self.data_version = int(get_meta(sqlite_conn, 'data_version', 0))
+                    self.phase = 'up to date'
+                    return
+
+        generation = max(_generations(self.db_path), default=0) + 1
+        staging_path = _generation_path(self.db_path, generation)
+        _remove_files(staging_path)
+        if published:
+            # start from a copy of the published database so the load stays incremental
+            self.phase = 'copying'
+            staging_conn = sqlite3.connect(staging_path)
+            with get_pool(self.db_path).reader() as sqlite_conn:
+                sqlite_conn.backup(staging_conn)
+            staging_conn.close()
+
+        self.phase = 'loading'
+        self.stats = init_db(self.csv_path, staging_path, force=self.force, progress=self._progress
+                             , workers=self.workers)
+        self.phase = 'publishing'
+        with get_pool(staging_path).writer() as sqlite_conn:
+            # nothing writes a published generation, so it can be a single rollback-journal file
+            sqlite_conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            sqlite_conn.execute("PRAGMA journal_mode = DELETE")
+            self.data_version = int(get_meta(sqlite_conn, 'data_version', 0))
+        close_pool(staging_path)
+        if self.after_load:
+            self.after_load(self.csv_path)
+        publish(staging_path, self.db_path)
+        database._data_versions[self.db_path] = self.data_version
+        database._published_files[self.db_path] = os.path.realpath(self.db_path)
+        _remove_old_generations(self.db_path, generation)
+        self.fraction = 1.0
+        self.phase = 'done'
+
+def start_ingest(csv_path, db_path=DB_PATH, after_load=None, workers=None, force=False):
+    """Start a background load of csv_path into db_path, or return the one already running."""
+    with _jobs_lock:
+        job = _jobs.get(db_path)
+        if job is None or not job.running:
+            job = _jobs[db_path] = IngestJob(csv_path, db_path, after_load, workers, force).start()
+        return job
+
+def latest_job(db_path=DB_PATH):
+    return _jobs.get(db_path)
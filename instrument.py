@@ -0,0 +1,92 @@
+import json
+import logging
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+# opt-in: off unless TEIKO_INSTRUMENT=1 or the sidebar toggle is switched on
+ENABLED_BY_DEFAULT = os.environ.get('TEIKO_INSTRUMENT') == '1'
+
+# full scans of these tables grow with the dataset and are flagged in the panel
+WATCHED_TABLES = {'sample', 'cell_count', 'cohort'}
+
+logger = logging.getLogger('teiko.instrument')
+if not logger.handlers:
+    _handler = logging.StreamHandler()
+    _handler.setFormatter(logging.Formatter('%(message)s'))
+    logger.addHandler(_handler)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+
+# streamlit runs each session's script in its own thread, so records are per thread
+_local = threading.local()
+
+_TABLE_REF = re.compile(r'\b(?:from|join)\s+(\w+)(?:\s+(?:as\s+)?(?!on\b|where\b|join\b|left\b|inner\b|group\b|order\b|limit\b)(\w+))?', re.I)
+
+def begin(enabled=ENABLED_BY_DEFAULT, **context):
+    """Start collecting records for the current script run (or stop, when not enabled)."""
+    _local.records = [] if enabled else None
+    _local.context = context
+
+def enabled():
+    return getattr(_local, 'records', None) is not None
+
+def records():
+    return list(getattr(_local, 'records', None) or [])
+
+def _emit(record):
+    record = dict(getattr(_local, 'context', {}), **record)
+    _local.records.append(record)
+    logger.info(json.dumps(record, default=str))
+
+@contextmanager
+def section(name, **fields):
+    """Time a block; extra fields can be added to the yielded dict before it closes."""
+    if not enabled():
+        yield {}
+        return
+    record = {'kind': 'section', 'name': name, **fields}
+    start = time.perf_counter()
+    try:
+        yield record
+    finally:
+        record['ms'] = (time.perf_counter() - start) * 1000
+        _emit(record)
+
+def table_aliases(sql):
+    aliases = {}
+    for table, alias in _TABLE_REF.findall(sql):
+        aliases[table.lower()] = table.lower()
+        if alias:
+            aliases[alias.lower()] = table.lower()
+    return aliases
+
+def full_scans(sql, plan_details):
+    """Tables from WATCHED_TABLES the plan reads with a SCAN rather than an index SEARCH."""
+    aliases = table_aliases(sql)
+    scanned = []
+    for detail in plan_details:
+        match = re.match(r'SCAN (\w+)', detail)
+        if match:
+            table = aliases.get(match.group(1).lower(), match.group(1).lower())
+            if table in WATCHED_TABLES:
+                scanned.append(table)
+    return scanned
+
+def explain(sqlite_conn, sql, params=()):
+    return [row[-1] for row in sqlite_conn.execute('EXPLAIN QUERY PLAN ' + sql, params).fetchall()]
+
+def record_query(sql, ms, rows, plan_details, cached=False, name=None):
+    if not enabled():
+        return
+    _emit({
+        'kind': 'query'
+        , 'name': name or ' '.join(sql.split())[:60]
+        , 'ms': ms
+        , 'rows': rows
+        , 'cached': cached
+        , 'plan': plan_details
+        , 'full_scans': full_scans(sql, plan_details)
+    })
@@ -0,0 +1,203 @@
+"""Per-subject trajectories of relative frequency over time_from_treatment_start.
+
+Samples are sorted once by (subject, time). After that every subject is a
+contiguous segment of the sorted arrays, described by its offsets, and each
+per-subject quantity is one vectorized pass over all segments: repeated
+samples at a timepoint are averaged with np.add.reduceat, the baseline is
+scattered to its segment, and the trapezoid areas between consecutive
+timepoints are summed per segment. No step loops over subjects in Python.
+"""
+import numpy as np
+import pandas as pd
+from batch_stats import STATS_COLUMNS, compare_matrix
+
+SUMMARY_COLUMNS = ['time_from_treatment_start', 'group', 'population', 'subjects', 'mean_percentage'
+                   , 'sd_percentage', 'mean_change', 'sd_change', 'sem_change']
+AUC_COLUMNS = ['subject', 'group', 'population', 'timepoints', 'first_time', 'last_time', 'baseline', 'auc'
+               , 'auc_change']
+BASELINE_TIME = 0
+
+def _segment_sums(matrix, starts):
+    # rows of matrix summed per segment; NaN counts as 0, the second result counts the values
+    present = ~np.isnan(matrix)
+    return np.add.reduceat(np.where(present, matrix, 0.0), starts), np.add.reduceat(present, starts)
+
+class Trajectories:
+    """Relative frequencies of each subject at each of its timepoints, sorted by (subject, time).
+
+    Points of subject i are rows offsets[i]:offsets[i + 1] of times, values
+    and change; several samples of a subject at one timepoint are averaged
+    into one point. Change is the difference to the subject's value at
+    baseline_time (NaN for subjects without a sample then). A subject's group
+    is the label of its first sample. All arrays are read-only.
+    """
+
+    def __init__(self, populations, subjects, times, values, labels, baseline_time=BASELINE_TIME):
+        self.populations = list(populations)
+        self.baseline_time = baseline_time
+        keep = np.flatnonzero(pd.notna(subjects) & ~np.isnan(times))
+        subject_codes, subject_names = pd.factorize(subjects[keep])
+
+        # the only sort, on one integer key: afterwards subjects are contiguous and their times
+        # ascending (ties are samples of a subject at one time, which are averaged anyway)
+        time_values, time_ranks = np.unique(times[keep], return_inverse=True)
+        order = np.argsort(subject_codes.astype(np.int64) * len(time_values) + time_ranks)
+        rows = keep[order]
+        subject_codes, times, values = subject_codes[order], times[rows], values[rows]
+
+        new_point = np.ones(len(times), dtype=bool)
+        new_point[1:] = (subject_codes[1:] != subject_codes[:-1]) | (times[1:] != times[:-1])
+        point_starts = np.flatnonzero(new_point)
+        if len(point_starts) < len(times):
+            sums, counts = _segment_sums(values, point_starts)
+            with np.errstate(invalid='ignore'):
+                values = sums / counts
+        self.values = values
+        self.times = times[point_starts]
+        point_subjects = subject_codes[point_starts]
+
+        new_subject = np.ones(len(point_starts), dtype=bool)
+        new_subject[1:] = point_subjects[1:] != point_subjects[:-1]
+        subject_starts = np.flatnonzero(new_subject)
+        self.offsets = np.append(subject_starts, len(point_starts))
+        self.n_subjects = len(subject_starts)
+        self.subjects = np.asarray(subject_names, dtype=object)[point_subjects[subject_starts]]
+        # labels are only looked up for each subject's first sample
+        self.labels = np.asarray(labels[rows[point_starts[subject_starts]]], dtype=object)
+        # index of each point's subject, to broadcast per-subject values to points
+        self.point_subject = np.cumsum(new_subject) - 1
+
+        # each subject has at most one point at baseline_time
+        baseline_row = np.full(self.n_subjects, -1)
+        at_baseline = np.flatnonzero(self.times == baseline_time)
+        baseline_row[self.point_subject[at_baseline]] = at_baseline
+        self.baseline = np.where((baseline_row >= 0)[:, None], self.values[baseline_row], np.nan)
+        self.change = self.values - self.baseline[self.point_subject]
+
+        self.timepoints = np.diff(self.offsets)
+        self.first_time = self.times[subject_starts]
+        self.last_time = self.times[self.offsets[1:] - 1]
+        self.auc = self._trapezoid(self.values)
+        # the area of (value - baseline) is the area of value less the baseline times the time span
+        self.auc_change = self.auc - self.baseline * (self.last_time - self.first_time)[:, None]
+
+        for name in ('values', 'times', 'offsets', 'subjects', 'labels', 'point_subject', 'baseline', 'change'
+                     , 'timepoints', 'first_time', 'last_time', 'auc', 'auc_change'):
+            getattr(self, name).flags.writeable = False
+
+    def _trapezoid(self, matrix):
+        """Area under each subject's piecewise linear curve (NaN for subjects with one timepoint)."""
+        if not self.n_subjects:
+            return np.empty((0, matrix.shape[1]))
+        # the area from each point to the next; the last point of a subject gets 0 instead of
+        # an area reaching into the next subject, so every segment sums exactly its own areas
+        areas = np.empty_like(matrix)
+        np.add(matrix[1:], matrix[:-1], out=areas[:-1])
+        areas[:-1] *= (np.diff(self.times) / 2)[:, None]
+        areas[self.offsets[1:] - 1] = 0.0
+        auc = np.add.reduceat(areas, self.offsets[:-1])
+        auc[self.timepoints < 2] = np.nan
+        return auc
+
+    def summary(self, groups=None):
+        """Mean and spread of the percentage and its change from baseline per timepoint, group and population."""
+        if groups is None:
+            groups = sorted(pd.unique(self.labels[pd.notna(self.labels)]))
+        group_codes = pd.Index(groups).get_indexer(self.labels)[self.point_subject]
+        keep = group_codes >= 0
+        if keep.all():
+            # no copies when every subject is in one of the groups
+            keep = slice(None)
+        time_values, time_codes = np.unique(self.times[keep], return_inverse=True)
+        n_cells = len(time_values) * len(groups)
+        n_populations = len(self.populations)
+        # one bin per (timepoint, group, population), so each sum is a single bincount
+        bins = ((time_codes * len(groups) + group_codes[keep])[:, None] * n_populations
+                + np.arange(n_populations)).ravel()
+
+        def moments(matrix):
+            # per cell and population: number of values, mean and sample standard deviation
+            present = ~np.isnan(matrix)
+            filled = np.where(present, matrix, 0.0)
+            n, total, squares = (
+                np.bincount(bins, weights.ravel(), n_cells * n_populations).reshape(n_cells, n_populations)
+                for weights in (present, filled, filled ** 2))
+            with np.errstate(divide='ignore', invalid='ignore'):
+                mean = total / n
+                sd = np.sqrt(np.maximum(squares - n * mean ** 2, 0.0) / (n - 1))
+            return n, mean, sd
+
+        n, mean_percentage, sd_percentage = moments(self.values[keep])
+        n_change, mean_change, sd_change = moments(self.change[keep])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            sem_change = sd_change / np.sqrt(n_change)
+        return pd.DataFrame({
+            'time_from_treatment_start': np.repeat(time_values, len(groups) * n_populations)
+            , 'group': np.tile(np.repeat(np.asarray(groups, dtype=object), n_populations), len(time_values))
+            , 'population': np.tile(self.populations, n_cells)
+            , 'subjects': n.ravel().astype(np.int64)
+            , 'mean_percentage': mean_percentage.ravel()
+            , 'sd_percentage': sd_percentage.ravel()
+            , 'mean_change': mean_change.ravel()
+            , 'sd_change': sd_change.ravel()
+            , 'sem_change': sem_change.ravel()
+        }, columns=SUMMARY_COLUMNS)
+
+    def compare_timepoints(self, groups=None, value='change'):
+        """compare_matrix of value ('change' or 'values') between groups at every timepoint, one subject per row."""
+        matrix = getattr(self, value)
+        point_labels = self.labels[self.point_subject]
+        # subjects without a baseline have no change to test; they are left out of n as well
+        has_value = ~np.isnan(matrix).all(axis=1)
+        times = np.unique(self.times)
+        if value == 'change':
+            # change is 0 for every subject at baseline, so there is nothing to compare there
+            times = times[times != self.baseline_time]
+        frames = []
+        # loops over the few distinct timepoints, never over subjects
+        for time in times:
+            at_time = (self.times == time) & has_value
+            frame = compare_matrix(self.populations, matrix[at_time], point_labels[at_time], groups)
+            frame.insert(0, 'time_from_treatment_start', time)
+            frames.append(frame)
+        if not frames:
+            return pd.DataFrame(columns=['time_from_treatment_start'] + STATS_COLUMNS)
+        return pd.concat(frames, ignore_index=True)
+
+    def compare_auc(self, groups=None, value='auc_change'):
+        """compare_matrix of the per-subject area under the curve ('auc' or 'auc_change') between groups.
+
+        Subjects with a single timepoint (or, for auc_change, no baseline) have no area and are left out.
+        """
+        matrix = getattr(self, value)
+        has_area = ~np.isnan(matrix).all(axis=1)
+        return compare_matrix(self.populations, matrix[has_area], self.labels[has_area], groups)
+
+    def auc_table(self, population=None):
+        """One row per subject and population (or only the given one) with its timepoints, baseline and areas."""
+        columns = list(range(len(self.populations))) if population is None else [self.populations.index(population)]
+        n_columns = len(columns)
+        return pd.DataFrame({
+            'subject': np.repeat(self.subjects, n_columns)
+            , 'group': np.repeat(self.labels, n_columns)
+            , 'population': np.tile(np.asarray(self.populations, dtype=object)[columns], self.n_subjects)
+            , 'timepoints': np.repeat(self.timepoints, n_columns)
+            , 'first_time': np.repeat(self.first_time, n_columns)
+            , 'last_time': np.repeat(self.last_time, n_columns)
+            , 'baseline': self.baseline[:, columns].ravel()
+            , 'auc': self.auc[:, columns].ravel()
+            , 'auc_change': self.auc_change[:, columns].ravel()
+        }, columns=AUC_COLUMNS)
+
+def cube_trajectories(cube, mask, group_column='response', baseline_time=BASELINE_TIME):
+    """Trajectories of the masked samples of a CountCube, grouped by group_column."""
+    codes = cube.codes['time_from_treatment_start'][mask]
+    time_values = np.append(np.asarray(cube.categories['time_from_treatment_start'], dtype=float), np.nan)
+
+    def categorical(column):
+        # the cube's codes as they are; only the values that end up in the result get decoded
+        return pd.Categorical.from_codes(cube.codes[column][mask], categories=cube.categories[column])
+
+    # code -1 (missing) picks the NaN appended at the end
+    return Trajectories(cube.populations, categorical('subject'), time_values[codes], cube.percentages[mask]
+                        , categorical(group_column), baseline_time)
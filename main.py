@@ -1,19 +1,198 @@
-import streamlit as st
-import pandas as pd
-import plotly.express as px
-from scipy.stats import ttest_ind, levene
-from database import init_db, q3_query, q4_query, q5a_query, q5b_query, q5c_query
+import inspect
+import os
 import sqlite3
-
-if 'cell_count_df' not in st.session_state:
-    st.session_state.cell_count_df = pd.read_csv('data/cell-count.csv')
-
-if 'sqlite_init' not in st.session_state:
-    init_db(st.session_state.cell_count_df)
-    st.session_state.sqlite_init = True
-
-sqlite_conn = sqlite3.connect("demo_db.sqlite")
-sqlite_cursor = sqlite_conn.cursor()
+import time
+import streamlit as st
+import instrument
+from cache import result_cache
+from pool import get_pool
+
+# pandas, pyarrow, scipy and plotly are imported inside the sections that use them,
+# so Home and "More about Leopold" start without them; see import_report.py
+
+CSV_PATH = 'data/cell-count.csv'
+
+# caps on what a summary box plot sends to the browser per group
+BOX_MAX_OUTLIERS = 50
+BOX_MAX_POINTS = 300
+# permutations and bootstrap resamples behind the 2b resampling table
+RESAMPLES = 10_000
+# plotly's first default colour, as px.box uses for a single series
+BOX_COLOR = '#636efa'
+
+# pages that read the cell-count data, and so trigger ingestion on first visit
+DATA_SECTIONS = ('Python Tasks', 'Database Tasks')
+
+# rows of a result shown on screen; the full result is only ever streamed to an export file
+PREVIEW_ROWS = 1000
+# exports up to this size can be downloaded from the page; the download button holds the whole file in memory
+DOWNLOAD_MAX_MB = int(os.environ.get('EXPORT_DOWNLOAD_MAX_MB', 200))
+
+# cohort used throughout Question 2, as (column, value) filters on the long frequencies
+TR1_MELANOMA_PBMC = (('treatment', 'tr1'), ('condition', 'melanoma'), ('sample_type', 'PBMC'))
+
+def start_ingest():
+    # loads run in a background thread into a new database file that is swapped in when
+    # complete, so pages keep reading the previous data meanwhile (see ingest.py)
+    from ingest import start_ingest
+    from snapshot import ensure_snapshot
+    return start_ingest(CSV_PATH, after_load=ensure_snapshot)
+
+# the first data page visited in this process starts ingestion; it is a no-op
+# when the published database was already built from the same csv content
+@st.cache_resource(show_spinner=False)
+def ingest_cell_counts():
+    return start_ingest()
+
+def current_data_version():
+    from database import data_version
+    ingest_cell_counts()
+    version = data_version()
+    if not version:
+        # nothing published yet; poll_ingest_progress reruns the page once there is
+        st.info('The cell-count data is being loaded for the first time. This page refreshes when it is ready.')
+        st.stop()
+    return version
+
+def show_ingest_progress():
+    from ingest import latest_job
+    job = latest_job()
+    if job is None:
+        return
+    if job.running:
+        poll_ingest_progress()
+        return
+    status = job.status()
+    if status['error']:
+        st.error(f"Loading {CSV_PATH} failed: {status['error']}")
+
+# only rendered while a load runs; reruns on its own every second, so progress updates
+# without rerunning the page, and reruns the whole page once the load has finished
+@st.fragment(run_every=1.0)
+def poll_ingest_progress():
+    from ingest import latest_job
+    job = latest_job()
+    if not job.running:
+        # the page renders against the new database (or shows the error) without this fragment
+        st.rerun()
+    status = job.status()
+    eta = f", about {status['eta_s']:.0f}s left" if status['eta_s'] is not None else ''
+    st.progress(status['fraction'], text=f"Loading data ({status['phase']}): {status['rows']:,} rows, "
+                                         f"{status['elapsed_s']:.0f}s{eta}")
+
+# memory-mapped arrow snapshot of the csv, so sessions share pages instead of re-parsing text
+@st.cache_resource(show_spinner=False, max_entries=2)
+def load_cell_counts(version):
+    from snapshot import read_snapshot
+    return read_snapshot(CSV_PATH)
+
+# the first PREVIEW_ROWS rows of the Question 1 table, shared by every session; callers must not mutate it
+@st.cache_resource(show_spinner=False, max_entries=2)
+def load_q1_preview(version):
+    from database import population_columns
+    from frequency import relative_frequency
+    table = load_cell_counts(version)
+    n_populations = max(len(population_columns(table.column_names)), 1)
+    samples = table.slice(0, -(-PREVIEW_ROWS // n_populations)).to_pandas()
+    return relative_frequency(samples, id_columns=[]).head(PREVIEW_ROWS), table.num_rows * n_populations
+
+# samples x populations counts with coded metadata and per-value bitmaps, shared read-only by every
+# session; cohorts (tuples of (column, value) filters) are bitmap intersections, not DataFrame copies
+@st.cache_resource(show_spinner=False, max_entries=2)
+def load_cube(version):
+    from cube import CountCube
+    # built from the memory-mapped Arrow columns; a pandas copy of the whole table is never made
+    return CountCube(load_cell_counts(version))
+
+# every population is tested in one batch per cohort and grouping; picking a population is a lookup
+@st.cache_resource(show_spinner=False, max_entries=16)
+def load_group_stats(version, cohort, group_column, groups=None):
+    from batch_stats import compare_matrix
+    cube = load_cube(version)
+    mask = cube.mask(cohort)
+    return compare_matrix(cube.populations, cube.percentages[mask], cube.values(group_column, mask), groups)
+
+# subject-level permutation p-values and bootstrap intervals; batches run on a process pool
+@st.cache_resource(show_spinner=False, max_entries=16)
+def load_resampling_stats(version, cohort, group_column, groups):
+    from resampling import compare_resampled_matrix
+    cube = load_cube(version)
+    mask = cube.mask(cohort)
+    return compare_resampled_matrix(cube.populations, cube.percentages[mask], cube.values(group_column, mask)
+                                    , cube.values('subject', mask), groups
+                                    , n_permutations=RESAMPLES, n_bootstrap=RESAMPLES)
+
+# quartiles, whiskers and a capped sample of outliers/points for every population and group
+@st.cache_resource(show_spinner=False, max_entries=16)
+def load_box_summary(version, cohort, group_column, groups=None):
+    from batch_stats import box_summary_matrix
+    cube = load_cube(version)
+    mask = cube.mask(cohort)
+    return box_summary_matrix(cube.populations, cube.percentages[mask], cube.values(group_column, mask), groups
+                              , max_outliers=BOX_MAX_OUTLIERS, max_points=BOX_MAX_POINTS)
+
+# per-subject trajectories over time_from_treatment_start, built with one sort over the cohort's samples
+@st.cache_resource(show_spinner=False, max_entries=16)
+def load_trajectories(version, cohort, group_column):
+    from longitudinal import cube_trajectories
+    cube = load_cube(version)
+    return cube_trajectories(cube, cube.mask(cohort), group_column)
+
+# per-timepoint summaries and comparisons and the per-subject AUC comparison, for every population at once
+@st.cache_resource(show_spinner=False, max_entries=16)
+def load_longitudinal_stats(version, cohort, group_column, groups):
+    trajectories = load_trajectories(version, cohort, group_column)
+    return trajectories.summary(groups), trajectories.compare_timepoints(groups), trajectories.compare_auc(groups)
+
+# distinct values behind the cohort explorer's filters
+@st.cache_resource(show_spinner=False, max_entries=2)
+def load_filter_options(version):
+    from cohort_query import filter_options
+    from database import DB_PATH
+    with get_pool(DB_PATH).reader() as sqlite_conn:
+        return filter_options(sqlite_conn)
+
+def box_figure(box_rows, group_column, value_column='percentage', show_points=False):
+    # one precomputed box per group: the payload is the same size for 10 or 10 million samples
+    import numpy as np
+    import plotly.graph_objects as go
+    fig = go.Figure()
+    rng = np.random.default_rng(0)
+    for x, row in enumerate(box_rows.itertuples()):
+        fig.add_trace(go.Box(
+            x=[x], q1=[row.q1], median=[row.median], q3=[row.q3], mean=[row.mean]
+            , lowerfence=[row.lower_fence], upperfence=[row.upper_fence]
+            , name=str(row.group), marker_color=BOX_COLOR, showlegend=False
+        ))
+        if len(row.outliers):
+            fig.add_trace(go.Scatter(
+                x=np.full(len(row.outliers), x), y=row.outliers, mode='markers', name=f'{row.group} outliers'
+                , marker=dict(color=BOX_COLOR, symbol='circle-open'), showlegend=False
+            ))
+        if show_points and len(row.points):
+            fig.add_trace(go.Scatter(
+                x=x + rng.uniform(-0.3, 0.3, len(row.points)), y=row.points, mode='markers'
+                , name=f'{row.group} sample', marker=dict(color=BOX_COLOR, size=4, opacity=0.3), showlegend=False
+            ))
+    fig.update_layout(
+        xaxis=dict(title=group_column, tickmode='array', tickvals=list(range(len(box_rows)))
+                   , ticktext=[str(g) for g in box_rows['group']])
+        , yaxis_title=value_column
+    )
+    return fig
+
+def read_sql(query, params=(), max_rows=PREVIEW_ROWS):
+    import pandas as pd
+    from database import DB_PATH
+    # each query checks out its own read-only connection from the shared pool
+    with get_pool(DB_PATH).reader() as sqlite_conn:
+        cursor = sqlite_conn.execute(query, params)
+        rows = cursor.fetchmany(max_rows + 1)
+        columns = [d[0] for d in cursor.description]
+        cursor.close()
+    result = pd.DataFrame(rows[:max_rows], columns=columns)
+    result.attrs['truncated'] = len(rows) > max_rows
+    return result
 
 def main():
     st.set_page_config(page_title="Teiko Technical Interview", layout="wide")
@@ -21,15 +200,68 @@ def main():
     # Sidebar
     st.sidebar.title("Navigation")
     section = st.sidebar.radio("Go to", ["Home", "Python Tasks", "Database Tasks", "More about Leopold"])
-
-    if section == 'Home':
-        show_home()
-    elif section == "Python Tasks":
-        show_python()
-    elif section == "Database Tasks":
-        show_database()
-    elif section == "More about Leopold":
-        show_leopold()
+    diagnostics = st.sidebar.toggle('Diagnostics', value=instrument.ENABLED_BY_DEFAULT)
+    instrument.begin(diagnostics, page=section)
+    if section in DATA_SECTIONS:
+        from database import data_version
+        if st.sidebar.button('Reload data', help=f'Re-read {CSV_PATH} in the background'):
+            start_ingest()
+        ingest_cell_counts()
+        # the version this run renders, so exports made against an older one aren't offered
+        st.session_state.data_version_seen = data_version()
+        with st.sidebar:
+            show_ingest_progress()
+
+    with instrument.section(f'page: {section}'):
+        if section == 'Home':
+            show_home()
+        elif section == "Python Tasks":
+            show_python()
+        elif section == "Database Tasks":
+            show_database()
+        elif section == "More about Leopold":
+            show_leopold()
+
+    if diagnostics:
+        show_diagnostics(section)
+
+def show_diagnostics(section):
+    import pandas as pd
+    records = instrument.records()
+    with st.sidebar.expander('Diagnostics', expanded=True):
+        job = None
+        if section in DATA_SECTIONS:
+            from ingest import latest_job
+            job = latest_job()
+        if job is None:
+            st.caption('Ingest: not needed by this page')
+        elif job.running:
+            st.caption(f"Ingest: {job.status()['phase']}")
+        elif job.stats:
+            st.caption(f"Ingest: {job.stats['rows']:,} rows in {job.stats['seconds']:.2f}s "
+                       f"({job.stats['rows_per_sec']:,.0f} rows/s)")
+        else:
+            st.caption(f"Ingest: database {job.status()['phase']}")
+
+        sections = pd.DataFrame([r for r in records if r['kind'] == 'section'], columns=['name', 'ms'])
+        st.dataframe(sections[['name', 'ms']], hide_index=True, column_config={
+            'ms': st.column_config.NumberColumn('ms', format='%.1f')
+        })
+
+        queries = [r for r in records if r['kind'] == 'query']
+        for q in queries:
+            if q['full_scans']:
+                st.warning(f"Full scan of {', '.join(q['full_scans'])} in {q['name']}")
+        if queries:
+            queries = pd.DataFrame(queries)
+            queries['plan'] = queries['plan'].str.join(' | ')
+            st.dataframe(queries[['name', 'ms', 'rows', 'cached', 'plan']], hide_index=True, column_config={
+                'ms': st.column_config.NumberColumn('ms', format='%.1f')
+            })
+
+        cache_stats = result_cache.stats()
+        st.caption(f"Result cache: {cache_stats['hits']:,} hits, {cache_stats['misses']:,} misses, "
+                   f"{cache_stats['entries']} entries, {cache_stats['bytes'] / 1024:,.0f} KiB")
 
 def display_question(question_title, question_text):
     st.header(question_title)
@@ -42,6 +274,10 @@ def show_home():
     
 
 def show_python():
+    import pandas as pd
+    import plotly.express as px
+    from frequency import relative_frequency
+
     st.header("Python Tasks")
 
     # QUESTION 1
@@ -52,53 +288,28 @@ def show_python():
 * count: cell count
 * percentage: relative frequency in percentage""")
 
-    relative_frequency = st.session_state.cell_count_df.copy()
-
-    relative_frequency['total_count'] = relative_frequency['b_cell'] + \
-                                        relative_frequency['cd8_t_cell'] + \
-                                        relative_frequency['cd4_t_cell'] + \
-                                        relative_frequency['nk_cell'] + \
-                                        relative_frequency['monocyte']
-
-    melted_rf = pd.melt(relative_frequency
-                        , id_vars=['sample']
-                        , value_vars=['b_cell', 'cd8_t_cell', 'cd4_t_cell', 'nk_cell', 'monocyte']
-                        , var_name='population'
-                        , value_name='count')
-    
-    melted_rf = melted_rf.merge(relative_frequency, how='left', on='sample')
-    melted_rf['percentage'] = melted_rf['count'] / melted_rf['total_count']
-
-    q1_result = melted_rf[['sample', 'total_count', 'population', 'count', 'percentage']]
+    with instrument.section('q1 relative frequency'):
+        version = current_data_version()
+        q1_result, q1_rows = load_q1_preview(version)
 
     with st.expander('See code'):
-        st.code("""
-relative_frequency = cell_count_df.copy()
-
-relative_frequency['total_count'] = relative_frequency['b_cell'] + \\
-                                    relative_frequency['cd8_t_cell'] + \\
-                                    relative_frequency['cd4_t_cell'] + \\
-                                    relative_frequency['nk_cell'] + \\
-                                    relative_frequency['monocyte']
-
-melted_rf = pd.melt(relative_frequency
-                    , id_vars=['sample']
-                    , value_vars=['b_cell', 'cd8_t_cell', 'cd4_t_cell', 'nk_cell', 'monocyte']
-                    , var_name='population'
-                    , value_name='count')
-
-melted_rf = melted_rf.merge(relative_frequency, how='left', on='sample')
-melted_rf['percentage'] = melted_rf['count'] / melted_rf['total_count']
-
-q1_result = melted_rf[['sample', 'total_count', 'population', 'count', 'percentage']]""", language='python')
+        st.code(inspect.getsource(relative_frequency), language='python')
     
-    q1_result['percentage'] = q1_result['percentage']*100
-    st.dataframe(q1_result, hide_index=True, column_config={
-        'percentage':st.column_config.NumberColumn(
-            'percentage',
-            format='%.2f%%'
-        )
-    })
+    with instrument.section('q1 table render', rows=len(q1_result)):
+        st.dataframe(q1_result, hide_index=True, column_config={
+            'percentage':st.column_config.NumberColumn(
+                'percentage',
+                format='%.2f%%'
+            )
+        })
+    if q1_rows > len(q1_result):
+        st.caption(f'Showing the first {len(q1_result):,} of {q1_rows:,} rows; export for all of them.')
+
+    def write_q1(path, fmt):
+        from export import export_question1
+        return export_question1(load_cell_counts(version), path, fmt)
+
+    show_export('q1', write_q1, 'question1')
 
     # QUESTION 2
     display_question('Question 2', '''Among patients who have treatment tr1, we are interested in comparing the differences in cell population relative frequencies of melanoma patients who respond (responders) to tr1 versus those who do not (non-responders), with the overarching aim of predicting response to treatment tr1. Response information can be found in column response, with value y for responding and value n for non-responding. Please only include PBMC (blood) sample.
@@ -112,39 +323,44 @@ b. Which cell populations are significantly different in relative frequencies be
 
     with st.expander('See code'):
         st.code("""
-# filter treatment, condition, and sample_type
-tr1_rf = melted_rf[melted_rf['treatment'] == 'tr1'].reset_index(drop=True)
-tr1_rf_melanoma = tr1_rf[tr1_rf['condition'] == 'melanoma'].reset_index(drop=True)
-tr1_rf_melanoma_pbmc = tr1_rf_melanoma[tr1_rf_melanoma['sample_type'] == 'PBMC'].reset_index(drop=True)
+# filter treatment, condition, and sample_type by intersecting the shared cube's bitmaps
+cube = load_cube(current_data_version())
+tr1_melanoma_pbmc = cube.mask(TR1_MELANOMA_PBMC)
 
 # creates two columns for streamlit
 selection, plot_col = st.columns([1, 4])
 
-pop = selection.radio('Select a population', options=['b_cell', 'cd8_t_cell', 'cd4_t_cell', 'nk_cell', 'monocyte'])
-
-# generates plotly boxplot for a specific population 
-tr1_rf_melanoma_pbmc_pop = tr1_rf_melanoma_pbmc[tr1_rf_melanoma_pbmc['population'] == pop]
-fig = px.box(tr1_rf_melanoma_pbmc_pop, x="response", y="percentage")
+pop = selection.radio('Select a population', options=cube.populations)
+box_mode = selection.radio('Box plot', options=['Summary', 'All points'])
+show_points = box_mode == 'Summary' and selection.checkbox('Overlay sampled points')
+
+# generates plotly boxplot for a specific population
+if box_mode == 'Summary':
+    # quartiles and whiskers are computed here, not in the browser
+    box_stats = load_box_summary(current_data_version(), TR1_MELANOMA_PBMC, 'response', ('y', 'n'))
+    fig = box_figure(box_stats[box_stats['population'] == pop], 'response', show_points=show_points)
+else:
+    fig = px.box(x=cube.values('response', tr1_melanoma_pbmc)
+                 , y=cube.percentages[tr1_melanoma_pbmc, cube.populations.index(pop)]
+                 , labels={'x': 'response', 'y': 'percentage'})
 fig.update_layout(title_text=f'Population: {pop}')
 plot_col.plotly_chart(fig)
 
-# statistics for 2b
-response_group = tr1_rf_melanoma_pbmc_pop[tr1_rf_melanoma_pbmc_pop['response'] == 'y'][pop].values
-non_response_group = tr1_rf_melanoma_pbmc_pop[tr1_rf_melanoma_pbmc_pop['response'] == 'n'][pop].values
-_, levene_p_value = levene(response_group, non_response_group)
-equal_variance = levene_p_value >= 0.05
-_, ttest_p_value = ttest_ind(response_group, non_response_group, equal_var=equal_variance)
+# statistics for 2b: Levene, t-tests, effect sizes and BH-adjusted p values
+# for every population at once, cached per cohort
+response_stats = load_group_stats(current_data_version(), TR1_MELANOMA_PBMC, 'response', ('y', 'n'))
+pop_stats = response_stats.set_index('population').loc[pop]
 
 with plot_col.expander('Detailed Statistics for 2b'):
     detailed_stats = pd.DataFrame(
         [
-            ['Levene Variance Test p value', round(levene_p_value, 4)]
-            , ['Equal Variance', equal_variance]
-            , ['Independent t-test used', 'standard t-test' if equal_variance else "Welch's t-test"]
-            , ['t-test p value', round(ttest_p_value, 4)]
-            , ['N Total', len(tr1_rf_melanoma_pbmc_pop.index)]
-            , ['N Response', len(response_group)]
-            , ['N Non-Response', len(non_response_group)]
+            ['Levene Variance Test p value', round(pop_stats['levene_p'], 4)]
+            , ['Equal Variance', pop_stats['equal_variance']]
+            , ['Independent t-test used', pop_stats['test']]
+            , ['t-test p value', round(pop_stats['p_value'], 4)]
+            , ['N Total', pop_stats['n_a'] + pop_stats['n_b']]
+            , ['N Response', pop_stats['n_a']]
+            , ['N Non-Response', pop_stats['n_b']]
         ]
         , columns=['Description', 'Value']
     )
@@ -152,47 +368,68 @@ with plot_col.expander('Detailed Statistics for 2b'):
 
     st.header('Cell Population Response Boxplot')
 
-    # filter treatment, condition, and sample_type
-    tr1_rf = melted_rf[melted_rf['treatment'] == 'tr1'].reset_index(drop=True)
-    tr1_rf_melanoma = tr1_rf[tr1_rf['condition'] == 'melanoma'].reset_index(drop=True)
-    tr1_rf_melanoma_pbmc = tr1_rf_melanoma[tr1_rf_melanoma['sample_type'] == 'PBMC'].reset_index(drop=True)
+    # filter treatment, condition, and sample_type by intersecting the shared cube's bitmaps
+    cube = load_cube(current_data_version())
+    tr1_melanoma_pbmc = cube.mask(TR1_MELANOMA_PBMC)
 
     # creates two columns for streamlit
     selection, plot_col = st.columns([1, 4])
 
-    pop = selection.radio('Select a population', options=['b_cell', 'cd8_t_cell', 'cd4_t_cell', 'nk_cell', 'monocyte'])
-
-    # generates plotly boxplot for a specific population 
-    tr1_rf_melanoma_pbmc_pop = tr1_rf_melanoma_pbmc[tr1_rf_melanoma_pbmc['population'] == pop]
-    fig = px.box(tr1_rf_melanoma_pbmc_pop, x="response", y="percentage")
-    fig.update_layout(title_text=f'Population: {pop}')
-    plot_col.plotly_chart(fig)
+    pop = selection.radio('Select a population', options=cube.populations)
+    box_mode = selection.radio('Box plot', options=['Summary', 'All points'])
+    show_points = box_mode == 'Summary' and selection.checkbox('Overlay sampled points')
+
+    # generates plotly boxplot for a specific population
+    with instrument.section('q2a boxplot', mode=box_mode):
+        if box_mode == 'Summary':
+            # quartiles and whiskers are computed here, not in the browser
+            box_stats = load_box_summary(current_data_version(), TR1_MELANOMA_PBMC, 'response', ('y', 'n'))
+            fig = box_figure(box_stats[box_stats['population'] == pop], 'response', show_points=show_points)
+        else:
+            fig = px.box(x=cube.values('response', tr1_melanoma_pbmc)
+                         , y=cube.percentages[tr1_melanoma_pbmc, cube.populations.index(pop)]
+                         , labels={'x': 'response', 'y': 'percentage'})
+        fig.update_layout(title_text=f'Population: {pop}')
+        plot_col.plotly_chart(fig)
 
     # statistics for 2b
-    response_group = tr1_rf_melanoma_pbmc_pop[tr1_rf_melanoma_pbmc_pop['response'] == 'y']
-    non_response_group = tr1_rf_melanoma_pbmc_pop[tr1_rf_melanoma_pbmc_pop['response'] == 'n']
-    _, levene_p_value = levene(response_group[pop].values, non_response_group[pop].values)
-    equal_variance = levene_p_value >= 0.05
-    _, ttest_p_value = ttest_ind(response_group[pop].values, non_response_group[pop].values, equal_var=equal_variance)
+    with instrument.section('q2b statistics'):
+        response_stats = load_group_stats(current_data_version(), TR1_MELANOMA_PBMC, 'response', ('y', 'n'))
+        pop_stats = response_stats.set_index('population').loc[pop]
+    response_group = cube.mask(TR1_MELANOMA_PBMC + (('response', 'y'),))
+    non_response_group = cube.mask(TR1_MELANOMA_PBMC + (('response', 'n'),))
 
     with plot_col.expander('Detailed Statistics for 2b'):
         detailed_stats = pd.DataFrame(
             [
-                ['Levene Variance Test p value', round(levene_p_value, 4)]
-                , ['Equal Variance', equal_variance]
-                , ['Indedpendent t-test used', 'standard t-test' if equal_variance else "Welch's t-test"]
-                , ['t-test p value', round(ttest_p_value, 4)]
-                , ['# Samples', len(tr1_rf_melanoma_pbmc_pop.index)]
-                , ['# Samples Response', len(response_group[pop].values)]
-                , ['# Samples Non-Response', len(non_response_group[pop].values)]
-                , ['Unique Subjects', len(tr1_rf_melanoma_pbmc_pop.subject.unique())]
-                , ['Unique Subjects Response', len(response_group.subject.unique())]
-                , ['Unique Subjects Non-Response', len(non_response_group.subject.unique())]
+                ['Levene Variance Test p value', round(pop_stats['levene_p'], 4)]
+                , ['Equal Variance', pop_stats['equal_variance']]
+                , ['Indedpendent t-test used', pop_stats['test']]
+                , ['t-test p value', round(pop_stats['p_value'], 4)]
+                , ['Benjamini-Hochberg adjusted p value', round(pop_stats['p_adjusted'], 4)]
+                , ["Cohen's d", round(pop_stats['cohens_d'], 4)]
+                , ['# Samples', pop_stats['n_a'] + pop_stats['n_b']]
+                , ['# Samples Response', pop_stats['n_a']]
+                , ['# Samples Non-Response', pop_stats['n_b']]
+                , ['Unique Subjects', cube.count_unique('subject', tr1_melanoma_pbmc)]
+                , ['Unique Subjects Response', cube.count_unique('subject', response_group)]
+                , ['Unique Subjects Non-Response', cube.count_unique('subject', non_response_group)]
             ]
             , columns=['Description', 'Value']
         )
         st.dataframe(detailed_stats, hide_index=True)
 
+    with st.expander('Statistics for all populations'):
+        st.dataframe(response_stats, hide_index=True)
+
+    with st.expander('Permutation test and bootstrap interval (subject-level)'):
+        with instrument.section('q2b resampling'):
+            resampling_stats = load_resampling_stats(current_data_version(), TR1_MELANOMA_PBMC, 'response', ('y', 'n'))
+        st.write(f"""Difference in mean relative frequency (responders minus non-responders). Whole subjects are
+relabelled for the permutation p-value (exact when there are at most {RESAMPLES:,} relabellings) and drawn with
+replacement within each group for the 95% bootstrap interval, since several samples can come from one subject.""")
+        st.dataframe(resampling_stats, hide_index=True)
+
     st.subheader('2b')
     st.write("""
 After filtering treatment to "tr1", condition to "melanoma", and sample type to "PBMC", we have a total of 9 samples (6 response and 3 non-response) for 6 unique subjects (4 response and 2 non-response). It is generally recommended to have 30+ samples (ideally 30+ subjects) in each category before we can start making statistical inferences.
@@ -200,13 +437,117 @@ After filtering treatment to "tr1", condition to "melanoma", and sample type to
 If we ignore the 30+ observations recommendation for the purposes of a technical interview, the t-tests can be used to determine if there is a significant difference between the two groups. We can see the results of running t-tests for each population under the "Detailed Statistics for 2b" expansion above. The relative frequency for "cd4_t_cell" and "monocyte" populations are statistically different (t-test p-value < 0.05) between response and non-response groups. 
              
 I came to this conclusion by first performing a Levene Variance test to determine if the two groups have significantly different variances. If the groups have significatly different variances, it's recommended to perform the Welch's t-test over the standard t-test. Since all populations resulted in equal variances, I performed the standard t-test.
+
+Testing five populations at once inflates the chance of a false positive, so the statistics also include Benjamini-Hochberg adjusted p values. After that correction only "cd4_t_cell" stays below 0.05.
 """)
 
-def display_query_and_results(query):
+    st.header('Change from Baseline')
+    st.write("""Each subject's relative frequency at every timepoint minus its own value at day 0, averaged per
+group (error bars are standard errors). The area under each subject's curve of that change summarises the whole
+trajectory in one number per subject, so responders and non-responders can be compared with one value each.""")
+
+    with instrument.section('q2 longitudinal'):
+        trajectories = load_trajectories(current_data_version(), TR1_MELANOMA_PBMC, 'response')
+        timepoint_summary, timepoint_stats, auc_stats = load_longitudinal_stats(
+            current_data_version(), TR1_MELANOMA_PBMC, 'response', ('y', 'n'))
+    pop_summary = timepoint_summary[timepoint_summary['population'] == pop]
+    fig = px.line(pop_summary, x='time_from_treatment_start', y='mean_change', color='group', error_y='sem_change'
+                  , markers=True, labels={'mean_change': 'change in percentage', 'group': 'response'})
+    fig.update_layout(title_text=f'Population: {pop}')
+    st.plotly_chart(fig)
+
+    with st.expander('Responders vs non-responders at each timepoint'):
+        st.dataframe(pop_summary, hide_index=True)
+        st.dataframe(timepoint_stats[timepoint_stats['population'] == pop], hide_index=True)
+
+    with st.expander('Area under the curve per subject'):
+        st.dataframe(auc_stats[auc_stats['population'] == pop], hide_index=True)
+        auc_table = trajectories.auc_table(pop)
+        st.dataframe(auc_table.head(PREVIEW_ROWS), hide_index=True)
+        if len(auc_table) > PREVIEW_ROWS:
+            st.caption(f'Showing the first {PREVIEW_ROWS:,} of {len(auc_table):,} subjects.')
+
+def display_query_and_results(query, name=None, params=()):
     st.code(query, language='sql')
-    st.write(pd.read_sql(query, sqlite_conn))
+    if params:
+        st.caption('Parameters: ' + ', '.join(repr(p) for p in params))
+    executed = False
+
+    def run():
+        nonlocal executed
+        executed = True
+        return read_sql(query, params)
+
+    # reruns are served from the shared cache until the next ingest bumps the data version
+    start = time.perf_counter()
+    try:
+        result = result_cache.get_or_run(query, current_data_version(), run, params)
+    except sqlite3.Error as e:
+        st.error(f'Query failed: {e}')
+        return
+    elapsed_ms = (time.perf_counter() - start) * 1000
+    st.write(result)
+    if result.attrs.get('truncated'):
+        st.caption(f'Showing the first {PREVIEW_ROWS:,} rows; export the query for all of them.')
+
+    from database import DB_PATH
+    from export import export_query
+    show_export(name, lambda path, fmt: export_query(query, path, fmt, params, DB_PATH), name)
+
+    if instrument.enabled():
+        with get_pool(DB_PATH).reader() as sqlite_conn:
+            plan = instrument.explain(sqlite_conn, query, params)
+        instrument.record_query(query, elapsed_ms, len(result), plan, cached=not executed, name=name)
+
+def show_export(key, write, file_name):
+    """Export controls for a result that is only previewed on screen.
+
+    write(path, fmt) streams the full result to path and returns its row count.
+    The file stays on disk until the next export or the next data version. It
+    is only read into memory for a download button when the user asks for
+    one, and exports over DOWNLOAD_MAX_MB are left on disk instead.
+    """
+    from export import FORMATS, ExportError, new_export_path
+    from guarded_query import GuardedQueryError
+    left, middle, right = st.columns([1, 1, 4], vertical_alignment='center')
+    fmt = left.selectbox('Export format', list(FORMATS), key=f'{key}_format', label_visibility='collapsed')
+    state_key = f'{key}_exported'
+    if middle.button('Export', key=f'{key}_export'):
+        previous = st.session_state.pop(state_key, None)
+        if previous and os.path.exists(previous['path']):
+            os.remove(previous['path'])
+        path = new_export_path(fmt)
+        try:
+            with instrument.section(f'export {key} ({fmt})') as record:
+                rows = write(path, fmt)
+                record['rows'] = rows
+        except (ExportError, GuardedQueryError, sqlite3.Error) as e:
+            os.remove(path)
+            st.error(f'Export failed: {e}')
+        else:
+            st.session_state[state_key] = {'path': path, 'fmt': fmt, 'rows': rows
+                                           , 'version': st.session_state.get('data_version_seen')}
+    exported = st.session_state.get(state_key)
+    if not (exported and exported['version'] == st.session_state.get('data_version_seen')
+            and os.path.exists(exported['path'])):
+        return
+    size = os.path.getsize(exported['path'])
+    size_text = f'{size / 1024 / 1024:,.1f} MB' if size >= 1024 * 1024 else f'{size / 1024:,.1f} KB'
+    label = f"{exported['rows']:,} rows ({exported['fmt']}, {size_text})"
+    if size > DOWNLOAD_MAX_MB * 1024 * 1024:
+        right.caption(f"Exported {label}, over the {DOWNLOAD_MAX_MB} MB download limit of the page. The file is "
+                      f"at `{exported['path']}` on the server; `python export.py` writes the same result anywhere.")
+    elif right.button(f'Prepare download of {label}', key=f'{key}_prepare'):
+        # only this run holds the file in memory; the next rerun drops the button and its data
+        with open(exported['path'], 'rb') as f:
+            right.download_button(f'Download {label}', f, file_name=f"{file_name}.{exported['fmt']}"
+                                  , mime=FORMATS[exported['fmt']], key=f'{key}_download', on_click='ignore')
 
 def show_database():
+    from database import (DB_PATH, q3_query, q4_query, q4_params, q5a_query, q5a_params, q5b_query, q5b_params
+                          , q5c_query, q5c_params)
+    from export import export_guarded_query
+
     st.header("Database Tasks")
 
 
@@ -235,13 +576,13 @@ The `cell-count.csv` file provided had multiple samples from a given patient but
 
     st.write('Rather than writing queries against a hypothetically database, I decided to build this exact schema in SQLite. The queries below actually query the database and display the results. I imported the `cell-count.csv` data into the SQLite database. At the bottom of this page, there is a section where you can write your own query against this database.')
     
-    display_query_and_results(q3_query)
+    display_query_and_results(q3_query, 'q3')
 
     st.write("Note: Subjects with no recorded condition (None/Null) are considered 'healthy.'")
 
     display_question('Database Question 4', """Please write a query that returns all melanoma PBMC sample at baseline (time_from_treatment_start is 0) from patients who have treatment tr1.""")
 
-    display_query_and_results(q4_query)
+    display_query_and_results(q4_query, 'q4', q4_params)
 
     display_question('Database Question 5', """Please write queries to provide these following further breakdowns for the sample in (4):
 
@@ -252,18 +593,93 @@ b. How many responders/non-responders
 c. How many males, females""")
 
     st.subheader('a.')
-    display_query_and_results(q5a_query)
+    display_query_and_results(q5a_query, 'q5a', q5a_params)
 
     st.subheader('b.')
-    display_query_and_results(q5b_query)
+    display_query_and_results(q5b_query, 'q5b', q5b_params)
 
     st.subheader('c.')
-    display_query_and_results(q5c_query)
+    display_query_and_results(q5c_query, 'q5c', q5c_params)
+
+    show_cohort_explorer()
 
     st.header('Run your own query')
     query_text = st.text_area('Please write your own query!', height=340)
     if st.button('Run Query!'):
-        st.write(pd.read_sql(query_text, sqlite_conn))
+        st.session_state.adhoc_query = query_text
+        # an explicit run executes again even when the text is unchanged
+        st.session_state.pop('adhoc_result', None)
+    query = st.session_state.get('adhoc_query')
+    if query:
+        page = st.number_input('Page', min_value=1, value=1, step=1)
+        result, report, plan, error, executed = adhoc_page(query, page - 1)
+        if error:
+            st.error(error)
+            return
+        st.write(result)
+        st.caption(f"{report['elapsed_s'] * 1000:.1f} ms, {report['rows_read']:,} rows read, "
+                   f"~{report['vm_steps']:,} VM steps" + (', more rows on the next page' if report['has_more'] else ''))
+        show_export('adhoc', lambda path, fmt: export_guarded_query(query, path, fmt, DB_PATH), 'query')
+        if plan is not None:
+            instrument.record_query(query, report['elapsed_s'] * 1000, len(result), plan, cached=not executed
+                                    , name='ad-hoc query')
+
+def adhoc_page(query, page):
+    """(page DataFrame, report, plan, error, executed) for one page of an ad-hoc query.
+
+    The page is kept in session_state keyed by (query, page, data version), so
+    reruns from other widgets reuse it; only a new query, another page or new
+    data runs the query (and its plan, with diagnostics on) again. Errors are
+    kept the same way, so a query that timed out isn't retried on every rerun.
+    """
+    from database import DB_PATH
+    from guarded_query import GuardedQueryError, run_guarded_query
+    key = (query, page, current_data_version())
+    cached = st.session_state.get('adhoc_result')
+    executed = cached is None or cached['key'] != key
+    if executed:
+        cached = st.session_state.adhoc_result = {'key': key, 'result': None, 'report': None, 'plan': None
+                                                  , 'error': None}
+        try:
+            cached['result'], cached['report'] = run_guarded_query(DB_PATH, query, page=page)
+        except GuardedQueryError as e:
+            cached['error'] = str(e)
+    if instrument.enabled() and cached['error'] is None and cached['plan'] is None:
+        # the plan goes through the same guard as the query itself
+        try:
+            plan, _ = run_guarded_query(DB_PATH, 'EXPLAIN QUERY PLAN ' + query)
+        except GuardedQueryError:
+            cached['plan'] = []
+        else:
+            cached['plan'] = plan['detail'].tolist()
+    return cached['result'], cached['report'], cached['plan'], cached['error'], executed
+
+def show_cohort_explorer():
+    from cohort_query import DIMENSIONS, cohort_sql
+    from database import NO_CONDITION, NO_TREATMENT
+
+    st.header('Explore a cohort')
+    st.write('Questions 4 and 5 are built by the same query builder as this section. Pick any filters and breakdown: '
+             'only the tables they need are joined, and values are bound as parameters, so every cohort of the same '
+             'shape reuses one prepared statement.')
+    options = load_filter_options(current_data_version())
+    # None matches subjects without a condition or treatment
+    missing_labels = {'condition': NO_CONDITION, 'treatment': NO_TREATMENT}
+    filters = {}
+    columns = st.columns(3)
+    for i, name in enumerate(['sample_type', 'condition', 'treatment', 'project', 'sex', 'response']):
+        values = options[name] + ([None] if name in missing_labels else [])
+        filters[name] = columns[i % 3].multiselect(
+            name.replace('_', ' ').capitalize(), values, key=f'cohort_{name}'
+            , format_func=lambda v, name=name: missing_labels[name] if v is None else str(v))
+    low, high = options['time_from_treatment_start']
+    if low is not None and low < high:
+        days = st.slider('Days from treatment start', low, high, (low, high), key='cohort_days')
+        if days != (low, high):
+            filters['time_from_treatment_start'] = days
+    group_by = st.multiselect('Group by', list(DIMENSIONS), default=['response'], key='cohort_group_by')
+    sql, params = cohort_sql(filters, group_by)
+    display_query_and_results(sql, 'cohort', params)
 
 def show_leopold():
     st.header("Leopold Marx")
@@ -0,0 +1,176 @@
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+MMAP_SIZE = 256 * 1024 * 1024
+CACHE_SIZE_KIB = 64 * 1024
+BUSY_TIMEOUT_MS = 5000
+MAX_READERS = int(os.environ.get('SQLITE_READERS', os.cpu_count() or 4))
+# prepared statements kept per connection, keyed by SQL text; bound-parameter queries
+# (see cohort_query.py) reuse one entry for every set of values
+STATEMENT_CACHE_SIZE = 256
+# how long a checkout waits for a free reader before giving up
+CHECKOUT_TIMEOUT_S = float(os.environ.get('SQLITE_CHECKOUT_TIMEOUT', 30))
+
+class PoolTimeout(sqlite3.OperationalError):
+    # a sqlite3.Error, so callers that already handle query errors report it the same way
+    pass
+
+def _configure(sqlite_conn):
+    sqlite_conn.execute(f"PRAGMA busy_timeout = {BUSY_TIMEOUT_MS}")
+    sqlite_conn.execute(f"PRAGMA mmap_size = {MMAP_SIZE}")
+    # negative cache_size is in KiB rather than pages
+    sqlite_conn.execute(f"PRAGMA cache_size = -{CACHE_SIZE_KIB}")
+    return sqlite_conn
+
+def connect_writer(db_path):
+    sqlite_conn = sqlite3.connect(db_path, check_same_thread=False, cached_statements=STATEMENT_CACHE_SIZE)
+    # WAL lets readers keep reading the last committed snapshot while the writer works
+    sqlite_conn.execute("PRAGMA journal_mode = WAL")
+    sqlite_conn.execute("PRAGMA synchronous = NORMAL")
+    return _configure(sqlite_conn)
+
+def connect_reader(db_path):
+    sqlite_conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True, check_same_thread=False
+                                  , cached_statements=STATEMENT_CACHE_SIZE)
+    sqlite_conn.execute("PRAGMA query_only = 1")
+    return _configure(sqlite_conn)
+
+class ConnectionPool:
+    """One writer connection plus up to max_readers read-only connections.
+
+    Connections are opened lazily and handed to one thread at a time, so they
+    can be shared between Streamlit session threads safely. A checkout waits
+    up to checkout_timeout seconds for a reader to be returned or a slot to
+    free up (a reader closed after an error), then raises PoolTimeout. After
+    refresh() (db_path now points at a different file) readers are reopened:
+    idle ones at once, ones in use when they are returned.
+    """
+
+    def __init__(self, db_path, max_readers=MAX_READERS, checkout_timeout=CHECKOUT_TIMEOUT_S):
+        self.db_path = db_path
+        self.max_readers = max_readers
+        self.checkout_timeout = checkout_timeout
+        self._writer = None
+        self._writer_lock = threading.Lock()
+        # idle (generation, connection) pairs, most recently returned last
+        self._idle = []
+        self._opened = 0
+        # guards _idle and _opened; notified whenever a reader is returned or a slot frees up
+        self._available = threading.Condition()
+        self._generation = 0
+
+    @contextmanager
+    def writer(self):
+        with self._writer_lock:
+            if self._writer is None:
+                self._writer = connect_writer(self.db_path)
+            yield self._writer
+
+    @contextmanager
+    def reader(self):
+        generation, sqlite_conn = self._checkout()
+        try:
+            yield sqlite_conn
+        except sqlite3.Error:
+            # don't hand a connection in an unknown state to the next caller
+            self._discard(sqlite_conn)
+            raise
+        except BaseException:
+            self._release(generation, sqlite_conn)
+            raise
+        else:
+            self._release(generation, sqlite_conn)
+
+    def _checkout(self):
+        deadline = time.monotonic() + self.checkout_timeout
+        stale = []
+        try:
+            with self._available:
+                while True:
+                    while self._idle:
+                        generation, sqlite_conn = self._idle.pop()
+                        if generation == self._generation:
+                            return generation, sqlite_conn
+                        stale.append(sqlite_conn)
+                        self._opened -= 1
+                    if self._opened < self.max_readers:
+                        self._opened += 1
+                        generation = self._generation
+                        break
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise PoolTimeout(f'all {self.max_readers} database readers stayed busy for '
+                                          f'{self.checkout_timeout:g}s; try again shortly')
+                    self._available.wait(remaining)
+        finally:
+            for sqlite_conn in stale:
+                sqlite_conn.close()
+        try:
+            return generation, connect_reader(self.db_path)
+        except sqlite3.Error:
+            self._free_slot()
+            raise
+
+    def _release(self, generation, sqlite_conn):
+        # a reader from before refresh() is closed rather than reused; _discard still wakes a waiter
+        with self._available:
+            if generation == self._generation:
+                self._idle.append((generation, sqlite_conn))
+                self._available.notify()
+                return
+        self._discard(sqlite_conn)
+
+    def _discard(self, sqlite_conn):
+        sqlite_conn.close()
+        self._free_slot()
+
+    def _free_slot(self):
+        with self._available:
+            self._opened -= 1
+            self._available.notify()
+
+    def refresh(self):
+        """Reconnect to db_path after it was swapped for another file.
+
+        Queries already running finish against the file they started on.
+        Their connections are closed when returned, which frees the slot for
+        a waiting checkout to open a reader on the new file.
+        """
+        with self._available:
+            self._generation += 1
+        self.close()
+
+    def close(self):
+        with self._writer_lock:
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
+        self._drain()
+
+    def _drain(self):
+        with self._available:
+            idle, self._idle = self._idle, []
+            self._opened -= len(idle)
+            self._available.notify_all()
+        for _, sqlite_conn in idle:
+            sqlite_conn.close()
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+def get_pool(db_path):
+    """Process-wide pool for db_path."""
+    with _pools_lock:
+        if db_path not in _pools:
+            _pools[db_path] = ConnectionPool(db_path)
+        return _pools[db_path]
+
+def close_pool(db_path):
+    """Close and forget the pool for db_path, e.g. once a staging file has been published."""
+    with _pools_lock:
+        pool = _pools.pop(db_path, None)
+    if pool is not None:
+        pool.close()
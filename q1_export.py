@@ -0,0 +1,68 @@
+"""Write the Question 1 long-format CSV without starting Streamlit.
+
+    python q1_export.py data/cell-count.csv -o question1.csv
+
+Inputs are read in chunks; chunks are converted in a process pool and
+written back in input order, so the output is identical for any --workers
+value and memory stays bounded by the chunks in flight.
+"""
+import argparse
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import pandas as pd
+from frequency import Q1_COLUMNS, relative_frequency
+
+DEFAULT_CHUNKSIZE = 200_000
+
+def convert_chunk(chunk):
+    return relative_frequency(chunk, id_columns=[])[Q1_COLUMNS].to_csv(index=False, header=False)
+
+def _chunks(paths, chunksize):
+    for path in paths:
+        yield from pd.read_csv(path, chunksize=chunksize)
+
+def export(paths, output, chunksize=DEFAULT_CHUNKSIZE, workers=None):
+    """Stream the Question 1 rows for every csv in paths to output; returns (input rows, seconds)."""
+    rows = 0
+    start = time.perf_counter()
+    output.write(','.join(Q1_COLUMNS) + '\n')
+    if workers == 1:
+        for chunk in _chunks(paths, chunksize):
+            output.write(convert_chunk(chunk))
+            rows += len(chunk)
+        return rows, time.perf_counter() - start
+
+    workers = workers or os.cpu_count() or 1
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        # keep a bounded window of chunks in flight and drain it in submission order
+        window = 2 * workers
+        pending = deque()
+        for chunk in _chunks(paths, chunksize):
+            pending.append(pool.submit(convert_chunk, chunk))
+            rows += len(chunk)
+            if len(pending) >= window:
+                output.write(pending.popleft().result())
+        while pending:
+            output.write(pending.popleft().result())
+    return rows, time.perf_counter() - start
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Convert cell-count CSVs to the Question 1 relative frequency CSV.')
+    parser.add_argument('inputs', nargs='+', help='cell-count CSV files, processed in the order given')
+    parser.add_argument('-o', '--output', default='-', help='output CSV path (default: stdout)')
+    parser.add_argument('--chunksize', type=int, default=DEFAULT_CHUNKSIZE, help='input rows per chunk')
+    parser.add_argument('--workers', type=int, default=None, help='worker processes (default: CPU count, 1 = no pool)')
+    args = parser.parse_args(argv)
+
+    if args.output == '-':
+        rows, elapsed = export(args.inputs, sys.stdout, args.chunksize, args.workers)
+    else:
+        with open(args.output, 'w', newline='') as output:
+            rows, elapsed = export(args.inputs, output, args.chunksize, args.workers)
+    print(f'{rows:,} samples in {elapsed:.2f}s ({rows / elapsed if elapsed else 0:,.0f} samples/s)', file=sys.stderr)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,179 @@
+"""Subject-level permutation tests and bootstrap intervals for two groups of samples.
+
+Samples repeat per subject, so resampling moves whole subjects: a permutation
+reassigns the group labels of subjects, a bootstrap draws subjects with
+replacement within each group. The statistic is the difference in mean value
+(e.g. percentage) over samples, for every population at once.
+
+Each batch of resamples is a 0/1 (or count) weight matrix of resamples x
+subjects; multiplying it by the per-subject sums and sample counts gives every
+resampled group mean in one matmul. Batches get their own seeds spawned from
+the caller's seed, so results are identical for any number of workers.
+"""
+import os
+from concurrent.futures import ProcessPoolExecutor
+from itertools import combinations
+from math import comb
+from multiprocessing import get_context
+import numpy as np
+import pandas as pd
+from batch_stats import sample_matrix
+
+RESAMPLING_COLUMNS = ['population', 'group_a', 'group_b', 'subjects_a', 'subjects_b', 'difference'
+                      , 'permutation_p', 'exact', 'n_permutations', 'ci_low', 'ci_high', 'n_bootstrap']
+
+# weight matrix cells per batch (8 bytes each), which bounds the memory of a batch
+BATCH_CELLS = 4_000_000
+
+def subject_sums(long_df, group_column, groups, subject_column='subject', value_column='percentage'):
+    """Per-subject value sums and sample counts (subjects x populations) and each subject's group.
+
+    Returns (populations, sums, counts, in_a) with subjects of groups[0] first.
+    Raises ValueError when a subject's samples carry more than one group label.
+    """
+    frame = long_df[long_df[group_column].isin(groups)]
+    populations, matrix, labels = sample_matrix(frame, group_column, value_column)
+    sample_subjects = np.empty(len(labels), dtype=object)
+    sample_codes, _ = pd.factorize(frame['sample'])
+    sample_subjects[sample_codes] = frame[subject_column].to_numpy(dtype=object)
+    return (populations, *subject_totals(matrix, labels, sample_subjects, groups, group_column))
+
+def subject_totals(matrix, labels, sample_subjects, groups, group_column='group'):
+    """subject_sums from a samples x populations matrix, group labels and subject ids per sample.
+
+    Samples whose label is not in groups are left out. Returns (sums, counts, in_a).
+    """
+    keep = np.isin(labels, groups)
+    matrix, labels = matrix[keep], labels[keep]
+    subject_codes, subjects = pd.factorize(sample_subjects[keep])
+
+    subject_labels = pd.Series(labels).groupby(subject_codes).agg(['first', 'nunique'])
+    if (subject_labels['nunique'] > 1).any():
+        raise ValueError(f'subjects must belong to a single {group_column} group for subject-level resampling')
+
+    present = ~np.isnan(matrix)
+    sums = np.zeros((len(subjects), matrix.shape[1]))
+    counts = np.zeros((len(subjects), matrix.shape[1]))
+    np.add.at(sums, subject_codes, np.where(present, matrix, 0))
+    np.add.at(counts, subject_codes, present)
+
+    in_a = (subject_labels['first'] == groups[0]).to_numpy()
+    order = np.argsort(~in_a, kind='stable')
+    return sums[order], counts[order], in_a[order]
+
+def _difference(weights_a, weights_b, sums_a, counts_a, sums_b, counts_b):
+    # rows of weights are resamples; each row yields mean_a - mean_b for every population
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return (weights_a @ sums_a) / (weights_a @ counts_a) - (weights_b @ sums_b) / (weights_b @ counts_b)
+
+def _split_difference(in_a, sums, counts):
+    # every subject outside group a is in group b, so one matmul gives the totals of both
+    n_populations = sums.shape[1]
+    totals_a = in_a @ np.hstack([sums, counts])
+    sums_a, counts_a = totals_a[:, :n_populations], totals_a[:, n_populations:]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return sums_a / counts_a - (sums.sum(axis=0) - sums_a) / (counts.sum(axis=0) - counts_a)
+
+def _permutation_batch(seed, size, sums, counts, n_a, observed):
+    """Count permuted |differences| at least as extreme as observed, per population."""
+    rng = np.random.default_rng(seed)
+    # the n_a smallest random keys of a row pick a uniformly random set of subjects for group a
+    keys = rng.random((size, len(sums)))
+    threshold = np.partition(keys, n_a - 1, axis=1)[:, n_a - 1:n_a]
+    differences = _split_difference((keys <= threshold).astype(np.float64), sums, counts)
+    return (np.abs(differences) >= np.abs(observed) - 1e-9).sum(axis=0)
+
+def _bootstrap_batch(seed, size, sums_a, counts_a, sums_b, counts_b):
+    """Resampled differences (size x populations) from subjects drawn with replacement per group."""
+    rng = np.random.default_rng(seed)
+    return _difference(_draw_counts(rng, size, len(sums_a)), _draw_counts(rng, size, len(sums_b))
+                       , sums_a, counts_a, sums_b, counts_b)
+
+def _draw_counts(rng, size, n):
+    # how often each of n subjects is drawn in each of size resamples of n draws with replacement;
+    # one flat bincount over (resample, subject) cells is much faster than rng.multinomial per row
+    cells = rng.integers(0, n, (size, n)) + (np.arange(size) * n)[:, None]
+    return np.bincount(cells.ravel(), minlength=size * n).reshape(size, n).astype(np.float64)
+
+def _batches(n_resamples, n_subjects, seed):
+    size = max(1, min(n_resamples, BATCH_CELLS // max(n_subjects, 1)))
+    sizes = [size] * (n_resamples // size) + ([n_resamples % size] if n_resamples % size else [])
+    return list(zip(np.random.SeedSequence(seed).spawn(len(sizes)), sizes))
+
+def _map_batches(function, batches, args, workers):
+    # a single batch (or workers=1) runs in this process; spawning workers would cost more than it saves
+    if workers == 1 or len(batches) == 1:
+        return [function(seed, size, *args) for seed, size in batches]
+    # spawned workers: this runs on Streamlit's script threads, and forking a threaded process can deadlock
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count() or 1, mp_context=get_context('spawn')) as pool:
+        futures = [pool.submit(function, seed, size, *args) for seed, size in batches]
+        return [future.result() for future in futures]
+
+def permutation_test(sums, counts, n_a, n_resamples=10_000, seed=0, workers=None):
+    """Two-sided permutation p-values of the difference in means, per population.
+
+    When the number of distinct subject relabellings is at most n_resamples
+    they are all enumerated and the p-value is exact; otherwise it is the
+    Monte-Carlo estimate (1 + hits) / (1 + n_resamples). Returns
+    (observed difference, p-values, exact, resamples used).
+    """
+    n = len(sums)
+    observed = _split_difference((np.arange(n) < n_a)[None, :].astype(np.float64), sums, counts)[0]
+    n_relabellings = comb(n, n_a)
+    if n_relabellings <= n_resamples:
+        labels = np.zeros((n_relabellings, n))
+        for row, members in enumerate(combinations(range(n), n_a)):
+            labels[row, list(members)] = 1
+        differences = _split_difference(labels, sums, counts)
+        hits = (np.abs(differences) >= np.abs(observed) - 1e-9).sum(axis=0)
+        return observed, hits / n_relabellings, True, n_relabellings
+
+    hits = sum(_map_batches(_permutation_batch, _batches(n_resamples, n, seed), (sums, counts, n_a, observed), workers))
+    return observed, (1 + hits) / (1 + n_resamples), False, n_resamples
+
+def bootstrap_ci(sums, counts, n_a, n_resamples=10_000, confidence=0.95, seed=0, workers=None):
+    """Percentile bootstrap interval of the difference in means, resampling subjects within each group."""
+    args = (sums[:n_a], counts[:n_a], sums[n_a:], counts[n_a:])
+    differences = np.concatenate(_map_batches(_bootstrap_batch, _batches(n_resamples, len(sums), seed), args, workers))
+    tail = (1 - confidence) / 2 * 100
+    with np.errstate(invalid='ignore'):
+        low, high = np.nanpercentile(differences, [tail, 100 - tail], axis=0)
+    return low, high
+
+def compare_resampled(long_df, group_column='response', groups=('y', 'n'), value_column='percentage'
+                      , subject_column='subject', n_permutations=10_000, n_bootstrap=10_000
+                      , confidence=0.95, seed=0, workers=None):
+    """Permutation p-value and bootstrap interval of mean(groups[0]) - mean(groups[1]) per population."""
+    populations, sums, counts, in_a = subject_sums(long_df, group_column, groups, subject_column, value_column)
+    return _compare_totals(populations, sums, counts, in_a, groups, group_column, n_permutations, n_bootstrap
+                           , confidence, seed, workers)
+
+def compare_resampled_matrix(populations, matrix, labels, sample_subjects, groups=('y', 'n'), n_permutations=10_000
+                             , n_bootstrap=10_000, confidence=0.95, seed=0, workers=None):
+    """compare_resampled on a samples x populations matrix with a group label and subject id per sample."""
+    sums, counts, in_a = subject_totals(matrix, labels, sample_subjects, groups)
+    return _compare_totals(populations, sums, counts, in_a, groups, 'group', n_permutations, n_bootstrap
+                           , confidence, seed, workers)
+
+def _compare_totals(populations, sums, counts, in_a, groups, group_column, n_permutations, n_bootstrap
+                    , confidence, seed, workers):
+    group_a, group_b = groups
+    n_a = int(in_a.sum())
+    if n_a == 0 or n_a == len(in_a):
+        raise ValueError(f'both {group_column} groups need at least one subject')
+    observed, p_values, exact, used = permutation_test(sums, counts, n_a, n_permutations, seed, workers)
+    ci_low, ci_high = bootstrap_ci(sums, counts, n_a, n_bootstrap, confidence, seed, workers)
+    return pd.DataFrame({
+        'population': populations
+        , 'group_a': group_a
+        , 'group_b': group_b
+        , 'subjects_a': n_a
+        , 'subjects_b': len(sums) - n_a
+        , 'difference': observed
+        , 'permutation_p': p_values
+        , 'exact': exact
+        , 'n_permutations': used
+        , 'ci_low': ci_low
+        , 'ci_high': ci_high
+        , 'n_bootstrap': n_bootstrap
+    }, columns=RESAMPLING_COLUMNS)